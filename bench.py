@@ -0,0 +1,387 @@
+"""
+Offline benchmark: runs the bridge against a local stand-in for the Telegram
+Bot API, a fake Max client and a fake Max CDN, so performance changes can be
+measured without live accounts.
+
+    python bench.py --messages 1000 --chats 4 --tg-latency 0.05 --error-rate 0.01
+
+Max -> Telegram messages go through the real queue/delivery pipeline, /send
+commands through send_handler. Reports throughput, p50/p99 latency and peak RSS.
+"""
+import argparse
+import json
+import logging
+import sys
+from asyncio import gather, run, sleep
+from itertools import count
+from os import chdir, environ, makedirs, path
+from random import Random
+from tempfile import TemporaryDirectory
+from time import perf_counter, time
+
+from aiohttp import web
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+REPO_DIR = path.dirname(path.abspath(__file__))
+MEDIA_SIZES = {"photo": 200 * 1024, "video": 4 * 1024 * 1024, "file": 1024 * 1024}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=500, help="Max -> Telegram messages to bridge")
+    parser.add_argument("--sends", type=int, default=50, help="/send commands to run (Telegram -> Max)")
+    parser.add_argument("--chats", type=int, default=2, help="number of bridged chat pairs")
+    parser.add_argument("--senders", type=int, default=20, help="distinct Max users writing")
+    parser.add_argument("--rate", type=float, default=0, help="Max messages per second to feed (0 - as fast as possible)")
+    parser.add_argument("--mix", default="text=50,reply=15,forward=10,photo=15,video=5,file=5",
+                        help="share of message kinds: text, reply, forward, photo, video, file")
+    parser.add_argument("--repeat-media", type=float, default=0.2, help="share of attachments that were already posted before")
+    parser.add_argument("--tg-latency", type=float, default=0.03, help="mean Bot API response time, s")
+    parser.add_argument("--max-latency", type=float, default=0.02, help="mean Max API response time, s")
+    parser.add_argument("--cdn-latency", type=float, default=0.02, help="Max CDN time to first byte, s")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls failing with a server/network error")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="share of Bot API calls answered with 429")
+    parser.add_argument("--real-limits", action="store_true", help="keep Telegram's rate limits (20 messages/min per chat)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's console log")
+    return parser.parse_args()
+
+class Backends:
+    """Local Bot API + Max CDN server with injected latency and errors."""
+
+    def __init__(self, args, rnd: Random):
+        self.args = args
+        self.rnd = rnd
+        self.tg_ids = count(1)
+        self.tg_calls = {}
+        self.tg_errors = 0
+        self.uploaded_bytes = 0
+        self.cdn_bytes = 0
+
+    def latency(self, mean: float) -> float:
+        return self.rnd.uniform(mean / 2, mean * 1.5)
+
+    def tg_message(self, chat_id, kind: str | None = None) -> dict:
+        message = {"message_id": next(self.tg_ids), "date": int(time()), "chat": {"id": int(chat_id), "type": "supergroup"}}
+        if kind:
+            file = {"file_id": f"{kind}-{message['message_id']}", "file_unique_id": str(message["message_id"])}
+            if kind == "photo":
+                message["photo"] = [file | {"width": 1, "height": 1}]
+            elif kind == "video":
+                message["video"] = file | {"width": 1, "height": 1, "duration": 1}
+            else:
+                message["document"] = file
+        return message
+
+    async def bot_api(self, request: web.Request):
+        method = request.match_info["method"]
+        self.tg_calls[method] = self.tg_calls.get(method, 0) + 1
+        form = await request.post()
+        for value in form.values():
+            if isinstance(value, web.FileField):
+                self.uploaded_bytes += len(value.file.read())
+        await sleep(self.latency(self.args.tg_latency))
+
+        roll = self.rnd.random()
+        if roll < self.args.flood_rate:
+            self.tg_errors += 1
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}}, status=429)
+        if roll < self.args.flood_rate + self.args.error_rate:
+            self.tg_errors += 1
+            return web.json_response({"ok": False, "error_code": 500, "description": "Internal Server Error"}, status=500)
+
+        chat_id = form.get("chat_id", 0)
+        if method == "sendMediaGroup":
+            result = [self.tg_message(chat_id, item["type"]) for item in json.loads(str(form["media"]))]
+        elif method == "editMessageText":
+            result = self.tg_message(chat_id) | {"message_id": int(str(form["message_id"]))}
+        else:
+            sent_media = {"sendPhoto": "photo", "sendVideo": "video", "sendDocument": "document"}
+            result = self.tg_message(chat_id, sent_media.get(method))
+        return web.json_response({"ok": True, "result": result})
+
+    async def cdn(self, request: web.Request):
+        await sleep(self.latency(self.args.cdn_latency))
+        if self.rnd.random() < self.args.error_rate:
+            return web.Response(status=503)
+        size = int(request.query["size"])
+        response = web.StreamResponse(headers={"Content-Length": str(size)})
+        await response.prepare(request)
+        if request.method == "HEAD":
+            # Size probe, not a download
+            return response
+        chunk = b"\0" * 65536
+        for offset in range(0, size, len(chunk)):
+            await response.write(chunk[:size - offset])
+        self.cdn_bytes += size
+        return response
+
+    async def start(self) -> str:
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_post("/bot{token}/{method}", self.bot_api)
+        app.router.add_get("/cdn/{kind}/{id}", self.cdn)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = site._server.sockets[0].getsockname()[:2] # pyright: ignore
+        return f"http://{host}:{port}"
+
+class FakeMaxClient:
+    """The parts of the PyMax client the bridge calls."""
+
+    def __init__(self, args, rnd: Random, base_url: str):
+        self.args = args
+        self.rnd = rnd
+        self.base_url = base_url
+        self.ids = count(10 ** 9)
+        self.calls = 0
+
+    async def _call(self):
+        self.calls += 1
+        await sleep(self.rnd.uniform(self.args.max_latency / 2, self.args.max_latency * 1.5))
+        if self.rnd.random() < self.args.error_rate:
+            raise ConnectionError("injected Max error")
+
+    def cdn_url(self, kind: str, item_id: int) -> str:
+        return f"{self.base_url}/cdn/{kind}/{item_id}?size={MEDIA_SIZES[kind]}"
+
+    async def fetch_users(self, user_ids):
+        from pymax.types import Names, User
+        await self._call()
+        return [User(account_status=0, update_time=0, id=uid, names=[Names(f"Пользователь {uid}", None, None, None)],
+                     gender=uid % 2 + 1) for uid in user_ids]
+
+    async def get_video_by_id(self, chat_id, message_id, video_id):
+        from pymax.types import VideoRequest
+        await self._call()
+        return VideoRequest(external="", cache=False, url=self.cdn_url("video", video_id))
+
+    async def get_file_by_id(self, chat_id, message_id, file_id):
+        from pymax.types import FileRequest
+        await self._call()
+        return FileRequest(unsafe=False, url=self.cdn_url("file", file_id))
+
+    async def send_message(self, text, chat_id, notify=True, attachment=None, attachments=None, reply_to=None, **kwargs):
+        from pymax.types import Message
+        await self._call()
+        return Message(chat_id=chat_id, sender=1, elements=None, reaction_info=None, options=None, id=next(self.ids),
+                       time=int(time() * 1000), link=None, text=text, status=None, type="USER", attaches=None)
+
+class MessageFactory:
+    """Synthetic Max messages of the requested mix."""
+
+    def __init__(self, args, rnd: Random, client: FakeMaxClient):
+        self.args = args
+        self.rnd = rnd
+        self.client = client
+        self.ids = count(1)
+        self.sent = {} # chat_id -> ids of earlier messages, for replies
+        self.posted = {} # attachment kind -> ids of attachments sent so far
+        mix = dict(part.split("=") for part in args.mix.split(","))
+        self.kinds = list(mix)
+        self.weights = [float(w) for w in mix.values()]
+
+    def attach(self, kind: str):
+        from pymax.static.enum import AttachType
+        from pymax.types import FileAttach, PhotoAttach, VideoAttach
+        # Reposts of the same picture/file keep their Max id
+        posted = self.posted.setdefault(kind, [])
+        if posted and self.rnd.random() < self.args.repeat_media:
+            item_id = self.rnd.choice(posted)
+        else:
+            item_id = next(self.ids)
+            posted.append(item_id)
+        if kind == "photo":
+            return PhotoAttach(base_url=self.client.cdn_url("photo", item_id), height=1, width=1, photo_id=item_id,
+                               photo_token="", preview_data=None, type=AttachType.PHOTO)
+        if kind == "video":
+            return VideoAttach(height=1, width=1, video_id=item_id, duration=1, preview_data="", type=AttachType.VIDEO,
+                               thumbnail="", token="", video_type=0)
+        return FileAttach(file_id=item_id, name=f"file{item_id}.bin", size=MEDIA_SIZES["file"], token="", type=AttachType.FILE)
+
+    def message(self, chat_id: int, kind: str, depth: int = 0):
+        from pymax.static.enum import FormattingType
+        from pymax.types import Element, Message, MessageLink
+        msg_id = next(self.ids)
+        link = None
+        attaches: list | None = None
+        # Markdown specials and a bold span, like real chat text
+        text = f"Сообщение {msg_id} snake_case *звёздочка* [скобки] " + "текст " * self.rnd.randint(1, 40)
+        elements = [Element(type=FormattingType.STRONG, length=9, from_=0)]
+        if kind == "reply" and self.sent.get(chat_id):
+            replied = self.rnd.choice(self.sent[chat_id])
+            link = MessageLink(chat_id=chat_id, message=self.message_stub(chat_id, replied), type="REPLY")
+        elif kind == "forward":
+            # Forwards of forwards exercise the recursion
+            inner = self.rnd.choice(["text", "photo", "forward"] if depth < 2 else ["text", "photo"])
+            link = MessageLink(chat_id=chat_id, message=self.message(chat_id, inner, depth + 1), type="FORWARD")
+        elif kind in ("photo", "video", "file"):
+            attaches = [self.attach(kind) for _ in range(self.rnd.choice([1, 1, 2, 3]))]
+            text = self.rnd.choice([text, ""])
+        if depth == 0:
+            self.sent.setdefault(chat_id, []).append(msg_id)
+        return Message(chat_id=chat_id, sender=self.rnd.randint(1, self.args.senders), elements=elements, reaction_info=None,
+                       options=None, id=msg_id, time=int(time() * 1000), link=link, text=text, status=None,
+                       type="USER", attaches=attaches)
+
+    def message_stub(self, chat_id: int, msg_id: int):
+        from pymax.types import Message
+        return Message(chat_id=chat_id, sender=1, elements=None, reaction_info=None, options=None, id=msg_id,
+                       time=0, link=None, text="", status=None, type="USER", attaches=None)
+
+    def next(self, chat_id: int):
+        return self.message(chat_id, self.rnd.choices(self.kinds, self.weights)[0])
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def peak_rss_mb() -> float | None:
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / 1024 ** 2 if sys.platform == "darwin" else rss / 1024, 1)
+
+def latency_report(latencies: list[float], elapsed: float) -> dict:
+    return {
+        "count": len(latencies),
+        "per_second": round(len(latencies) / elapsed, 1) if elapsed else 0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "max_ms": round(max(latencies, default=0) * 1000, 1),
+    }
+
+async def bench(args, main):
+    from aiogram import types
+    from aiogram.client.telegram import TelegramAPIServer
+    from throttle import TokenBucket
+
+    rnd = Random(args.seed)
+    backends = Backends(args, rnd)
+    base_url = await backends.start()
+    fake_max = FakeMaxClient(args, rnd, base_url)
+    main.client = fake_max
+    main.bot.session.api = TelegramAPIServer.from_base(base_url)
+    if not args.real_limits:
+        main.throttle.global_bucket = TokenBucket(10 ** 6, 10 ** 6)
+        main.throttle.chat_rate = main.throttle.chat_burst = 10 ** 6
+    main.throttle.base_delay = 0.05
+
+    # Time every delivery from the moment it is queued
+    queued_at = {}
+    max_latencies = []
+    deliver = main.deliver_max_message
+    async def timed_deliver(message, bridge, prefetch):
+        try:
+            await deliver(message, bridge, prefetch)
+        finally:
+            max_latencies.append(perf_counter() - queued_at[message.id])
+    main.deliver_max_message = timed_deliver
+
+    main.load_state()
+    await main.media.open_session()
+    main.deliveries.start()
+    factory = MessageFactory(args, rnd, fake_max)
+    bridges = list(main.router)
+
+    started = perf_counter()
+    for i in range(args.messages):
+        bridge = bridges[i % len(bridges)]
+        message = factory.next(bridge.max_chat_id)
+        queued_at[message.id] = perf_counter()
+        await main.queue_max_message(message, bridge)
+        if args.rate:
+            await sleep(max(0, started + (i + 1) / args.rate - perf_counter()))
+    await main.deliveries.join()
+    max_elapsed = perf_counter() - started
+
+    # Telegram -> Max, replying to bridged posts where possible
+    tg_ids = [
+        (bridge, tg_id) for bridge in bridges for max_id in factory.sent.get(bridge.max_chat_id, [])
+        if (tg_id := main.msgs_map.get(bridge.ns, max_id))
+    ]
+    send_latencies = []
+    async def send(i):
+        bridge, reply_to = rnd.choice(tg_ids) if tg_ids and i % 2 else (rnd.choice(bridges), None)
+        chat = {"id": bridge.tg_chat_id, "type": "supergroup"}
+        data = {"message_id": 10 ** 8 + i, "date": int(time()), "chat": chat, "text": f"/send ответ {i}",
+                "from": {"id": 1, "is_bot": False, "first_name": "Bench"}}
+        if reply_to:
+            data["reply_to_message"] = {"message_id": reply_to, "date": int(time()), "chat": chat}
+        message = types.Message.model_validate(data, context={"bot": main.bot})
+        t0 = perf_counter()
+        await main.send_handler(message)
+        send_latencies.append(perf_counter() - t0)
+    started = perf_counter()
+    await gather(*(send(i) for i in range(args.sends)))
+    send_elapsed = perf_counter() - started
+
+    await main.deliveries.stop()
+    await main.media.close_session()
+    await main.bot.session.close()
+    await backends.runner.cleanup()
+    main.msgs_map.close()
+
+    return {
+        "max_to_tg": latency_report(max_latencies, max_elapsed),
+        "tg_to_max": latency_report(send_latencies, send_elapsed),
+        "peak_rss_mb": peak_rss_mb(),
+        "telegram_calls": backends.tg_calls,
+        "telegram_injected_errors": backends.tg_errors,
+        "uploaded_mb": round(backends.uploaded_bytes / 1024 ** 2, 1),
+        "cdn_mb": round(backends.cdn_bytes / 1024 ** 2, 1),
+        "max_calls": fake_max.calls,
+        "bridge": main.collect_stats(),
+    }
+
+def print_report(report: dict):
+    for direction in ("max_to_tg", "tg_to_max"):
+        r = report[direction]
+        print(f"{direction}: {r['count']} messages, {r['per_second']} msg/s, "
+              f"p50 {r['p50_ms']} ms, p99 {r['p99_ms']} ms, max {r['max_ms']} ms")
+    rss = report["peak_rss_mb"]
+    print(f"peak RSS: {f'{rss} MB' if rss is not None else 'n/a'}")
+    print(f"telegram calls: {report['telegram_calls']} (injected errors: {report['telegram_injected_errors']})")
+    print(f"uploaded: {report['uploaded_mb']} MB, downloaded from CDN: {report['cdn_mb']} MB, Max calls: {report['max_calls']}")
+    print(f"bridge stats: {report['bridge']}")
+
+def main():
+    args = parse_args()
+    sys.path.insert(0, REPO_DIR)
+    with TemporaryDirectory(prefix="bridge-bench-") as work_dir:
+        # The bot keeps its state under ./data, keep the real one out of it
+        chdir(work_dir)
+        makedirs("data")
+        environ.update({
+            "TG_TOKEN": "123456:bench",
+            "VK_COOKIE": "bench",
+            "VK_PHONE": "+79990000000",
+            "BRIDGES": ",".join(f"-{i + 1}:-{1000 + i}" for i in range(args.chats)),
+            "ADMIN_USER_ID": "0",
+        })
+        environ.pop("BRIDGE_SHARD", None)
+        import main as bridge_main
+        if not args.verbose:
+            import logger
+            # In background mode the real handlers sit behind the queue listener
+            handlers = logger.listener.handlers if logger.listener else logging.getLogger().handlers
+            for handler in handlers:
+                if type(handler) is logging.StreamHandler:
+                    handler.setLevel(logging.CRITICAL)
+        report = run(bench(args, bridge_main))
+        chdir(REPO_DIR)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == "__main__":
+    main()
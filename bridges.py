@@ -0,0 +1,84 @@
+from bisect import bisect
+from dataclasses import dataclass
+from functools import lru_cache
+from hashlib import md5
+
+@dataclass
+class Bridge:
+    """One Max chat <-> Telegram chat pair and the delivery state that belongs to it."""
+    max_chat_id: int
+    tg_chat_id: int
+    last_sender_id: int | None = None
+    last_post: dict | None = None # last text-only post that later messages from the same sender may be appended to
+
+    @property
+    def ns(self) -> int:
+        """Namespace of this pair in the message store (TG message IDs are only unique per chat)."""
+        return self.tg_chat_id
+
+def parse_bridges(value: str) -> list[Bridge]:
+    """Parses "max_chat_id:tg_chat_id" pairs separated by commas, semicolons or newlines."""
+    bridges = []
+    for pair in value.replace(";", ",").replace("\n", ",").split(","):
+        pair = pair.strip()
+        if not pair:
+            continue
+        max_chat_id, sep, tg_chat_id = pair.partition(":")
+        if not sep:
+            raise ValueError(f"Bridge '{pair}' must look like MAX_CHAT_ID:TG_CHAT_ID")
+        bridges.append(Bridge(int(max_chat_id), int(tg_chat_id)))
+    return bridges
+
+def _ring_hash(value: str) -> int:
+    return int.from_bytes(md5(value.encode()).digest()[:8], "big")
+
+@lru_cache
+def _ring(shards: int, replicas: int) -> list[tuple[int, int]]:
+    return sorted((_ring_hash(f"{shard}:{replica}"), shard) for shard in range(shards) for replica in range(replicas))
+
+def shard_for(key, shards: int, replicas: int = 64) -> int:
+    """
+    Consistent-hash `key` onto one of `shards` workers.
+    Changing the worker count only moves about 1/N of the keys.
+    """
+    ring = _ring(shards, replicas)
+    i = bisect(ring, (_ring_hash(str(key)), shards)) % len(ring)
+    return ring[i][1]
+
+class Router:
+    """
+    Routing table between Max and Telegram chats.
+
+    When the bridges are split across worker processes, each worker knows
+    the whole table (for /send) but only delivers Max messages of its shard.
+    """
+
+    def __init__(self, bridges: list[Bridge], shard: int = 0, shards: int = 1):
+        if not bridges:
+            raise ValueError("No chats to bridge.")
+        self.bridges = bridges
+        self.by_max = {b.max_chat_id: b for b in bridges}
+        self.by_tg = {b.tg_chat_id: b for b in bridges}
+        if len(self.by_max) != len(bridges) or len(self.by_tg) != len(bridges):
+            raise ValueError("Every Max chat and every Telegram chat can only be bridged once.")
+        self.shard = shard
+        self.shards = shards
+        self.owned = [b for b in bridges if shards == 1 or shard_for(b.max_chat_id, shards) == shard]
+        self._owned_ids = {b.max_chat_id for b in self.owned}
+
+    def owns(self, bridge: Bridge) -> bool:
+        """Whether this process delivers the bridge's Max messages."""
+        return bridge.max_chat_id in self._owned_ids
+
+    def for_tg_chat(self, tg_chat_id: int) -> Bridge | None:
+        """Bridge of a Telegram chat. With a single bridge, commands from any chat (e.g. DMs) go to it."""
+        bridge = self.by_tg.get(tg_chat_id)
+        if bridge is None and len(self.bridges) == 1:
+            return self.bridges[0]
+        return bridge
+
+    def __iter__(self):
+        return iter(self.bridges)
+
+    def __len__(self):
+        return len(self.bridges)
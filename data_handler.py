@@ -1,5 +1,7 @@
 import json
 import logging
+from os import fdopen, path, replace
+from tempfile import mkstemp
 
 logger = logging.getLogger()
 
@@ -23,21 +25,40 @@ def load(key, file = "data/data.json"):
         logger.debug("Full error details:", exc_info=True)
         return None
 
-def save(key, value, file = "data/data.json"):
+def _read_all(file):
     try:
-        data = {}
-        try:
-            with open(file, "r") as f:
-                data = json.load(f)
-        except FileNotFoundError:
-            pass
+        with open(file, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
 
-        data[key] = value
+def _write_all(data, file):
+    # Write to a temp file and swap it in, so a crash never leaves half a JSON.
+    # A temp file of its own, so processes writing at once can't mix their contents.
+    fd, tmp_file = mkstemp(dir=path.dirname(file) or ".", prefix=path.basename(file), suffix=".tmp")
+    with fdopen(fd, "w") as f:
+        json.dump(data, f)
+    replace(tmp_file, file)
 
-        with open(file, "w") as f:
-            json.dump(data, f)
+def save(key, value, file = "data/data.json"):
+    try:
+        data = _read_all(file)
+        data[key] = value
+        _write_all(data, file)
         cache[key] = value
         logger.debug(f"Saved key '{key}' with value: {value}")
     except Exception as e:
         logger.error(f"Error saving key '{key}' - {type(e).__name__}: {str(e)}")
-        logger.debug("Full error details:", exc_info=True)
\ No newline at end of file
+        logger.debug("Full error details:", exc_info=True)
+
+def delete(key, file = "data/data.json"):
+    try:
+        data = _read_all(file)
+        if key in data:
+            del data[key]
+            _write_all(data, file)
+        cache.pop(key, None)
+        logger.debug(f"Deleted key '{key}'")
+    except Exception as e:
+        logger.error(f"Error deleting key '{key}' - {type(e).__name__}: {str(e)}")
+        logger.debug("Full error details:", exc_info=True)
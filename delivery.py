@@ -0,0 +1,87 @@
+import logging
+from asyncio import Lock, Queue, create_task, gather, CancelledError
+from time import monotonic
+
+import metrics
+
+logger = logging.getLogger()
+
+class DeliveryQueue:
+    """
+    Ordered hand-off between the Max listener and a pool of delivery workers.
+
+    Jobs with the same key (chat) run strictly one after another in arrival
+    order, different keys are spread across workers and run concurrently.
+    Worker queues are bounded, so when delivery falls behind put() waits
+    instead of piling up work in memory.
+    """
+
+    def __init__(self, workers=4, max_size=100):
+        self.queues = [Queue(max_size) for _ in range(workers)]
+        # Queue.put lets a new arrival take a freed slot before a woken blocked
+        # putter, so producers line up on a (FIFO) lock and one waits at a time
+        self.put_locks = [Lock() for _ in range(workers)]
+        self.tasks = []
+        self.processed = 0
+        self.failed = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def start(self):
+        self.tasks = [create_task(self._worker(queue), name=f"delivery-{i}") for i, queue in enumerate(self.queues)]
+
+    async def put(self, key, handler, *args, **kwargs):
+        """
+        Queue handler(*args, **kwargs) behind earlier jobs with the same key.
+
+        Ordering is decided when put() is called, so callers must not await
+        anything else before it.
+        """
+        index = hash(key) % len(self.queues)
+        queue = self.queues[index]
+        if queue.full():
+            logger.warning(f"Delivery queue for {key} is full ({queue.maxsize}), waiting")
+        async with self.put_locks[index]:
+            await queue.put((monotonic(), handler, args, kwargs))
+
+    async def _worker(self, queue: Queue):
+        while True:
+            enqueued_at, handler, args, kwargs = await queue.get()
+            self.last_lag = monotonic() - enqueued_at
+            self.max_lag = max(self.max_lag, self.last_lag)
+            metrics.stage_seconds.observe(self.last_lag, "queue_wait")
+            try:
+                await handler(*args, **kwargs)
+            except CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                metrics.errors.inc("delivery", type(e).__name__)
+                logger.error(f"Delivery job failed: {e}", exc_info=True)
+            finally:
+                self.processed += 1
+                queue.task_done()
+
+    async def join(self):
+        """Wait until everything queued so far is delivered."""
+        await gather(*(queue.join() for queue in self.queues))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    @property
+    def depth(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    @property
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "processed": self.processed,
+            "failed": self.failed,
+            "last_lag": round(self.last_lag, 3),
+            "max_lag": round(self.max_lag, 3),
+        }
@@ -0,0 +1,117 @@
+from aiogram.types import MessageEntity
+
+TEXT_LIMIT = 4096
+CAPTION_LIMIT = 1024
+
+# Max formatting element types -> Telegram entity types
+MAX_STYLES = {
+    "STRONG": "bold",
+    "EMPHASIZED": "italic",
+    "UNDERLINE": "underline",
+    "STRIKETHROUGH": "strikethrough",
+}
+
+def utf16_len(text: str) -> int:
+    """Length in UTF-16 code units, the unit Telegram counts offsets and limits in."""
+    return len(text.encode("utf-16-le")) // 2
+
+class FormattedText:
+    """
+    Text plus Telegram entities, built piece by piece.
+
+    Nothing is sent as Markdown, so user text never needs escaping and can't
+    break parsing. Entity offsets are kept in UTF-16 code units, like Max
+    element offsets and Telegram's own.
+    """
+
+    def __init__(self, text: str = "", *styles: str):
+        self.parts = []
+        self.spans = [] # (entity type, offset, length)
+        self.length = 0
+        self._split = {}
+        self.append(text, *styles)
+
+    def append(self, text: str, *styles: str) -> "FormattedText":
+        if text:
+            size = utf16_len(text)
+            self.spans.extend((style, self.length, size) for style in styles)
+            self.parts.append(text)
+            self.length += size
+            self._split.clear()
+        return self
+
+    def extend(self, other: "FormattedText") -> "FormattedText":
+        self.spans.extend((style, offset + self.length, size) for style, offset, size in other.spans)
+        self.parts.extend(other.parts)
+        self.length += other.length
+        self._split.clear()
+        return self
+
+    @classmethod
+    def from_max(cls, text: str, elements=None) -> "FormattedText":
+        """Max message text with its formatting elements. Unknown element types are dropped."""
+        formatted = cls(text)
+        for element in elements or []:
+            style = MAX_STYLES.get(element.type)
+            if style and element.length:
+                formatted.spans.append((style, element.from_ or 0, element.length))
+        return formatted
+
+    @property
+    def text(self) -> str:
+        if len(self.parts) > 1:
+            self.parts = ["".join(self.parts)]
+        return self.parts[0] if self.parts else ""
+
+    def entities(self) -> list[MessageEntity] | None:
+        entities = []
+        for style, offset, size in sorted(self.spans, key=lambda span: span[1]):
+            size = min(size, self.length - offset)
+            if size > 0:
+                entities.append(MessageEntity(type=style, offset=offset, length=size))
+        return entities or None
+
+    def split(self, limit: int = TEXT_LIMIT) -> list["FormattedText"]:
+        """
+        Cut into pieces of at most `limit` UTF-16 units, preferring line breaks,
+        then spaces. Entities are clipped to the pieces. Cached per limit.
+        """
+        if limit in self._split:
+            return self._split[limit]
+        pieces: list[FormattedText]
+        if self.length <= limit:
+            pieces = [self]
+        else:
+            units = self.text.encode("utf-16-le")
+            pieces = []
+            start = 0
+            while start < self.length:
+                end = min(start + limit, self.length)
+                skip = 0
+                if end < self.length:
+                    window = units[start * 2:end * 2].decode("utf-16-le", errors="ignore")
+                    for separator in ("\n", " "):
+                        cut = window.rfind(separator)
+                        if cut > len(window) // 2:
+                            end = start + utf16_len(window[:cut])
+                            skip = 1 # the separator itself is dropped
+                            break
+                    else:
+                        # Never cut a surrogate pair in half
+                        if 0xDC00 <= int.from_bytes(units[end * 2:end * 2 + 2], "little") <= 0xDFFF:
+                            end -= 1
+                piece = FormattedText(units[start * 2:end * 2].decode("utf-16-le"))
+                for style, offset, size in self.spans:
+                    lo, hi = max(offset, start), min(offset + size, end)
+                    if hi > lo:
+                        piece.spans.append((style, lo - start, hi - lo))
+                pieces.append(piece)
+                start = end + skip
+        self._split[limit] = pieces
+        return pieces
+
+    def strip(self) -> str:
+        return self.text.strip()
+
+    def __len__(self):
+        return self.length
@@ -1,7 +1,16 @@
+import atexit
+import json
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import SimpleQueue
 from sys import stdout
 
+# Set in background mode: the real handlers sit behind it
+listener: QueueListener | None = None
+
+# Attributes every LogRecord has; anything else was passed via `extra=`
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
 # Custom Formatter to exclude tracebacks for the console
 class ConsoleFormatterWithNoTraceback(logging.Formatter):
     """
@@ -34,9 +43,34 @@ class ConsoleFormatterWithNoTraceback(logging.Formatter):
 
         return formatted_message
 
-def setup_logger():
-    log_file = 'data/bot.log'
-    api_log_file = 'data/api_responses.log'
+class JsonFormatter(logging.Formatter):
+    """Formats records as JSON Lines, including fields passed via `extra=`."""
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRS)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class LazyQueueHandler(QueueHandler):
+    """
+    Hands records to the listener thread as they are.
+    The stock QueueHandler formats the message before queueing it, in the
+    caller's thread, which is exactly the work we want off the event loop.
+    """
+    def prepare(self, record):
+        return record
+
+def setup_logger(suffix: str = '', background: bool = False, json_lines: bool = False):
+    global listener
+    # Worker processes pass a suffix so they don't rotate each other's files
+    log_file = f'data/bot{suffix}.log'
+    api_log_file = f'data/api_responses{suffix}.log'
 
     try:
         open(log_file, 'x').close()
@@ -50,6 +84,8 @@ def setup_logger():
     file_formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(name)s: %(message)s', "%Y-%m-%d %H:%M:%S")
     console_formatter = ConsoleFormatterWithNoTraceback('%(asctime)s [%(levelname)s]: %(message)s', "%Y-%m-%d %H:%M:%S")
     api_formatter = logging.Formatter('%(asctime)s - %(message)s', "%Y-%m-%d %H:%M:%S")
+    if json_lines:
+        file_formatter = api_formatter = JsonFormatter(datefmt="%Y-%m-%dT%H:%M:%S")
 
     # --- Handlers ---
 
@@ -63,14 +99,12 @@ def setup_logger():
     file_handler.setFormatter(file_formatter)
     file_handler.setLevel(logging.DEBUG)
     file_handler.addFilter(lambda record: record.name != 'api_logger')
-    logger.addHandler(file_handler)
 
     # Console handler
     console_handler = logging.StreamHandler(stdout)
     console_handler.setFormatter(console_formatter)
     console_handler.setLevel(logging.INFO)
     console_handler.addFilter(lambda record: record.name != 'api_logger')
-    logger.addHandler(console_handler)
 
     # API response handler (separate file)
     api_handler = RotatingFileHandler(
@@ -83,7 +117,21 @@ def setup_logger():
     api_handler.setLevel(logging.INFO)
     # This filter ensures ONLY logs from 'api_logger' go to this file
     api_handler.addFilter(lambda record: record.name == 'api_logger')
-    logger.addHandler(api_handler)
+
+    handlers = (file_handler, console_handler, api_handler)
+    if background:
+        # Formatting, disk writes and rollover happen in the listener thread, callers only enqueue
+        queue = SimpleQueue()
+        listener = QueueListener(queue, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop) # flushes what's still queued
+        queue_handler = LazyQueueHandler(queue)
+        # Nothing below INFO reaches any file from api_logger, so don't even queue it
+        queue_handler.addFilter(lambda record: record.name != 'api_logger' or record.levelno >= logging.INFO)
+        logger.addHandler(queue_handler)
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
 
     # Get a specific logger instance for API calls
     api_logger = logging.getLogger('api_logger')
@@ -1,24 +1,38 @@
-from os import name as os_name, getenv
-from asyncio import run, wait, create_task, FIRST_COMPLETED, Event, get_running_loop
+from os import name as os_name, getenv, makedirs, path
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import monotonic, time
+from asyncio import run, sleep, wait, gather, create_task, current_task, to_thread, CancelledError, FIRST_COMPLETED, Event, Semaphore, Task, get_running_loop
 from logging import getLogger
+from random import random
 import signal
 from datetime import datetime, time as t
-from io import BytesIO
 
-import aiohttp
 from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, types
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
-from aiogram.types import BufferedInputFile
+from aiogram.types import InputFile, InputMediaDocument, InputMediaPhoto, InputMediaVideo
 
 from pymax import SocketMaxClient, MaxClient, Message
+from pymax.files import File, Photo, Video
 from pymax.types import FileAttach, PhotoAttach, VideoAttach
 
-import data_handler
+import max_send
+import media
+import metrics
+from bridges import Bridge, Router, parse_bridges
+from delivery import DeliveryQueue
+from formatting import CAPTION_LIMIT, TEXT_LIMIT, FormattedText
 from logger import setup_logger
+from msgs_store import MsgsStore
+from profile_cache import ProfileCache
+from throttle import ThrottleMiddleware
 
 # --- Initial Setup ---
-setup_logger()
+# Set by supervisor.py when bridges are split across worker processes: "index/count"
+BRIDGE_SHARD = getenv('BRIDGE_SHARD')
 l = getLogger("api_logger")
 load_dotenv()
 
@@ -29,10 +43,54 @@ END_TIME = t(22, 0)
 
 BOT_POST_MESSAGE = None # доп текст в сообщении от бота
 BOT_MESSAGE_PREFIX = "⫻" # префикс для отпарвляемых сообщений
+COALESCE_WINDOW = 0 # сообщения одного отправителя, пришедшие в течение стольких секунд, дописываются в предыдущее сообщение бота (0 - не объединять)
 BOT_START_MESSAGE = None # стартовое сообщение бота отпарвляемое в макс при запуске (если None, то не отпралвять)
 
 REQUESTS_TIMEOUT = 15 # таймаут запросов
 
+STREAM_MEDIA = True # передавать вложения из Max в Telegram потоком, не загружая их целиком
+MEDIA_SPILL_THRESHOLD = 8 * 1024 * 1024 # вложения больше этого размера (в байтах) скачиваются во временный файл, а не в память
+ATTACH_CONCURRENCY = 4 # сколько вложений одного сообщения скачивать одновременно
+MEDIA_GROUP_SIZE = 10 # максимум элементов в одном альбоме Telegram
+MEDIA_CACHE_SIZE = 5000 # сколько уже загруженных в Telegram вложений помнить, чтобы повторно пересылать их без скачивания (0 - не запоминать)
+TG_UPLOAD_LIMIT = 50 * 1024 * 1024 # файлы больше этого (в байтах) не скачиваются, вместо них в Telegram отправляется ссылка
+TG_LOCAL_UPLOAD_LIMIT = 2000 * 1024 * 1024 # то же, если используется свой сервер Bot API (TG_API_URL)
+TG_DOWNLOAD_LIMIT = 20 * 1024 * 1024 # больше этого (в байтах) бот не может скачать файл из Telegram для /send (у своего сервера Bot API - TG_LOCAL_UPLOAD_LIMIT)
+TG_DOWNLOAD_TIMEOUT = 300 # сколько секунд можно скачивать один файл из Telegram
+ALBUM_WAIT = 1.5 # сколько секунд ждать остальные части альбома, отправленного с /send
+TG_API_LOCAL_FILES = False # свой сервер Bot API запущен с --local на этой же машине: скачанные файлы передаются ему путём, а не загрузкой
+
+DELIVERY_WORKERS = 4 # сколько чатов доставлять в Telegram параллельно
+DELIVERY_QUEUE_SIZE = 100 # сколько сообщений может ждать доставки в одной очереди
+
+TG_GLOBAL_RATE = 30 # сколько запросов в секунду бот может отправлять в Telegram всего
+TG_CHAT_RATE = 20 / 60 # сколько сообщений в секунду можно отправлять в один чат (для групп Telegram разрешает 20 в минуту)
+TG_CHAT_BURST = 20 # сколько сообщений подряд можно отправить в чат без ожидания
+TG_MAX_RETRIES = 5 # сколько раз повторять запрос к Telegram при ошибке сети или флуд-контроле
+
+BACKFILL = True # досылать после перезапуска/переподключения сообщения из Max, которые не успели переслать
+BACKFILL_LIMIT = 200 # сколько сообщений истории Max запрашивать за раз
+BACKFILL_MAX_AGE = 24 * 3600 # не досылать сообщения старше этого (в секундах)
+
+MSGS_CACHE_SIZE = 10000 # сколько связок сообщений Max <-> Telegram держать в памяти (None - без ограничения)
+MSGS_MAX_AGE = None # через сколько секунд забывать связки сообщений (None - никогда)
+
+PROFILE_CACHE_TTL = 6 * 3600 # сколько секунд хранить профиль пользователя Max перед повторным запросом
+PROFILE_CACHE_SIZE = 1000 # сколько профилей держать в кеше
+
+DRAIN_TIMEOUT = 20 # сколько секунд при остановке дожидаться доставки уже полученных сообщений (недоставленные дошлются после перезапуска, если BACKFILL). Должно быть меньше SHUTDOWN_TIMEOUT в supervisor.py
+
+HEALTH_INTERVAL = 30 # как часто (в секундах) процесс-обработчик отчитывается супервизору (supervisor.py)
+
+LOG_IN_BACKGROUND = True # писать логи в фоновом потоке, чтобы запись на диск не задерживала пересылку
+LOG_JSON = False # писать файлы логов в формате JSON Lines (один объект на строку)
+LOG_MESSAGE_DUMP_RATE = 0 # какую долю входящих сообщений Max целиком записывать в api_responses.log (0 - никакую, 1 - все)
+
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = None # порт для метрик в формате Prometheus (http://METRICS_HOST:METRICS_PORT/metrics), None - не собирать. У процессов supervisor.py порт сдвигается на номер процесса
+
+setup_logger(f".{BRIDGE_SHARD.replace('/', '-')}" if BRIDGE_SHARD else '', background=LOG_IN_BACKGROUND, json_lines=LOG_JSON)
+
 # --- Environment Variables ---
 try:
     USE_SOCKET_CLIENT = eval(getenv('USE_SOCKET_CLIENT', 'False').title())
@@ -41,9 +99,16 @@ try:
     MAX_TOKEN = getenv('VK_COOKIE')
     TG_CHAT_ID = int(getenv('TG_CHAT_ID', 0))
     TG_TOKEN = getenv('TG_TOKEN')
+    TG_API_URL = getenv('TG_API_URL') # self-hosted telegram-bot-api, e.g. http://localhost:8081
     ADMIN_USER_ID = int(getenv('ADMIN_USER_ID', 0))
-    if not all([MAX_CHAT_ID, TG_CHAT_ID, TG_TOKEN, MAX_TOKEN, MAX_PHONE]):
+    # Several chat pairs at once: BRIDGES="max_chat_id:tg_chat_id,max_chat_id:tg_chat_id"
+    BRIDGES = getenv('BRIDGES') or (f"{MAX_CHAT_ID}:{TG_CHAT_ID}" if MAX_CHAT_ID and TG_CHAT_ID else "")
+    if not all([BRIDGES, TG_TOKEN, MAX_TOKEN, MAX_PHONE]):
         raise ValueError("One or more environment variables are not set.")
+    SHARD_INDEX, SHARD_COUNT = map(int, (BRIDGE_SHARD or '0/1').split('/'))
+    router = Router(parse_bridges(BRIDGES), SHARD_INDEX, SHARD_COUNT)
+    # Telegram allows only one getUpdates poller per bot, so the first worker handles all of Telegram -> Max
+    POLL_TELEGRAM = SHARD_INDEX == 0
 
     assert TG_TOKEN
     assert MAX_PHONE
@@ -51,38 +116,78 @@ except (ValueError, TypeError) as e:
     l.critical(f"FATAL: Configuration error - {e}. Please check your .env file.")
     quit(1)
 
-msgs_map = data_handler.load('msgs') or {}
-last_sender_id = None
+# Mappings stored before multi-bridge support belong to the first bridge.
+# Opened in the background by main(), handlers wait for `ready` before touching it.
+msgs_map = MsgsStore(cache_size=MSGS_CACHE_SIZE, max_age=MSGS_MAX_AGE, default_ns=router.bridges[0].ns, media_cache_size=MEDIA_CACHE_SIZE)
+prefetches: set[Task] = set() # attachment downloads of queued jobs, dropped on shutdown if the job never ran
+received_ids = set() # Max IDs queued but not yet delivered, so backfill doesn't queue them twice
+backfills: dict[int, Event] = {} # Max chat id -> set once the messages missed while offline are queued
+deliveries = DeliveryQueue(workers=DELIVERY_WORKERS, max_size=DELIVERY_QUEUE_SIZE)
+sends_in_flight: set[Task] = set() # /send handlers still running, waited for on shutdown
 
+ready = Event() # stores are loaded and deliveries are running
+max_ready = Event() # connected to Max at least once
+stopping = Event() # shutdown started, new Max messages are left for backfill
 
-bot = Bot(token=TG_TOKEN)
+
+if TG_API_URL:
+    bot = Bot(token=TG_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TG_API_URL, is_local=TG_API_LOCAL_FILES)))
+else:
+    bot = Bot(token=TG_TOKEN)
+UPLOAD_LIMIT = TG_LOCAL_UPLOAD_LIMIT if TG_API_URL else TG_UPLOAD_LIMIT
+DOWNLOAD_LIMIT = TG_LOCAL_UPLOAD_LIMIT if TG_API_URL else TG_DOWNLOAD_LIMIT
+throttle = ThrottleMiddleware(global_rate=TG_GLOBAL_RATE, chat_rate=TG_CHAT_RATE, chat_burst=TG_CHAT_BURST, max_retries=TG_MAX_RETRIES)
+bot.session.middleware(throttle)
 dp = Dispatcher()
 
+# Every worker process is its own Max device: PyMax keeps the session and device id in work_dir,
+# and processes sharing it would run several sessions under one device and race on its session.db
+MAX_WORK_DIR = "data/cache" if SHARD_INDEX == 0 else f"data/cache-{SHARD_INDEX}"
+# Temp files as well, so a worker clearing its leftovers at startup can't remove another's
+if SHARD_INDEX:
+    media.TEMP_DIR = f"data/tmp-{SHARD_INDEX}"
+
 # Reconnect=True effectively replaces the "Watchdog" thread
 if USE_SOCKET_CLIENT:
-    client = SocketMaxClient(MAX_PHONE, token=MAX_TOKEN, work_dir="data/cache", reconnect=True)
+    client = SocketMaxClient(MAX_PHONE, token=MAX_TOKEN, work_dir=MAX_WORK_DIR, reconnect=True)
 else:
-    client = MaxClient(MAX_PHONE, token=MAX_TOKEN, work_dir="data/cache", reconnect=True)
+    client = MaxClient(MAX_PHONE, token=MAX_TOKEN, work_dir=MAX_WORK_DIR, reconnect=True)
+
+async def fetch_profile(user_id: int) -> dict | None:
+    """Fetch the bits of a Max profile the bridge needs, bypassing PyMax's own cache."""
+    users = await client.fetch_users([user_id])
+    if not users:
+        return None
+    user = users[0]
+    return {"name": user.names[0].name if user.names else None, "gender": user.gender}
+
+profiles = ProfileCache(fetch_profile, msgs_map, ttl=PROFILE_CACHE_TTL, max_size=PROFILE_CACHE_SIZE)
+
+metrics.Gauge("bridge_delivery_queue_depth", "Max messages waiting for delivery to Telegram", lambda: deliveries.depth)
+metrics.Gauge("bridge_profile_cache_size", "Cached Max profiles", lambda: len(profiles.entries))
+metrics.Gauge("bridge_msgs_cache_size", "Max <-> Telegram message mappings held in memory", lambda: len(msgs_map.cache))
 
 # --- Helper Functions ---
 
-async def download_content(url: str) -> BytesIO:
-    """Download content from URL into memory."""
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, timeout=REQUESTS_TIMEOUT) as response: # pyright: ignore[reportArgumentType]
-            response.raise_for_status()
-            content = await response.read()
-            file_bytes = BytesIO(content)
-            # Attempt to set a name, though Telegram often overrides logic based on method
-            file_bytes.name = response.headers.get("X-File-Name", "file")
-            return file_bytes
+async def download_content(url: str, filename: str, prefetch: bool = False) -> InputFile:
+    """Prepare content from URL for upload: streamed, in memory or spilled to disk."""
+    if STREAM_MEDIA and not prefetch:
+        return media.StreamInputFile(url, filename, timeout=REQUESTS_TIMEOUT)
+    return await media.download(url, filename, spill_threshold=MEDIA_SPILL_THRESHOLD, timeout=REQUESTS_TIMEOUT, max_size=UPLOAD_LIMIT)
+
+def as_upload(input_file: InputFile | str) -> InputFile | str:
+    """A local Bot API server reads files the bot already has on disk by path, skipping the upload."""
+    if TG_API_URL and TG_API_LOCAL_FILES and isinstance(input_file, media.TempInputFile):
+        return f"file://{path.abspath(input_file.path)}"
+    return input_file
 
 async def get_sender_name(user_id: int) -> str:
     """Fetch user name via PyMax."""
     try:
-        user = await client.get_user(user_id=user_id)
-        if user and user.names:
-            return user.names[0].name or ''
+        with metrics.stage_seconds.time("profile"):
+            profile = await profiles.get(user_id)
+        if profile and profile["name"]:
+            return profile["name"]
     except Exception as e:
         l.error(f"Could not fetch profile for ID {user_id}: {e}")
     return f"User {user_id}"
@@ -92,56 +197,261 @@ async def get_sender_name(user_id: int) -> str:
 async def get_smart_sender_info(user_id: int):
     """Fetches name and determines gender-specific verb suffix."""
     try:
-        user = await client.get_user(user_id=user_id)
-        if user:
-            name = f"{user.names[0].name}" if user.names else f"User {user_id}"
+        with metrics.stage_seconds.time("profile"):
+            profile = await profiles.get(user_id)
+        if profile:
+            name = profile["name"] or f"User {user_id}"
             # Sex: 1 is Female, 2 is Male. Default to 'л' (male/neutral)
-            suffix = "ла" if user.gender == 1 else "л"
+            suffix = "ла" if profile["gender"] == 1 else "л"
             return name, suffix
     except Exception as e:
         l.error(f"Error fetching user {user_id}: {e}")
     return f"User {user_id}", "л(-а)"
 
+async def resolve_attachment(message: Message, attach) -> tuple[str, str, str] | None:
+    """Find where to download an attachment from. Returns (kind, url, filename)."""
+    if isinstance(attach, PhotoAttach):
+        return "photo", attach.base_url, "photo.jpg"
+    if isinstance(attach, VideoAttach):
+        vid_info = await client.get_video_by_id(message.chat_id, message.id, attach.video_id) # pyright: ignore[reportArgumentType]
+        if vid_info and vid_info.url:
+            return "video", vid_info.url, "video.mp4"
+    elif isinstance(attach, FileAttach):
+        file_info = await client.get_file_by_id(message.chat_id, message.id, attach.file_id) # pyright: ignore[reportArgumentType]
+        if file_info and file_info.url:
+            return "document", file_info.url, attach.name or 'file'
+    return None
+
+def media_key(attach) -> str | None:
+    """Identity of a Max attachment that stays the same wherever it is forwarded: "kind:id"."""
+    if isinstance(attach, PhotoAttach):
+        return f"photo:{attach.photo_id}"
+    if isinstance(attach, VideoAttach):
+        return f"video:{attach.video_id}"
+    if isinstance(attach, FileAttach):
+        return f"document:{attach.file_id}"
+    return None
+
+def sent_file_id(message: types.Message, kind: str) -> str | None:
+    """Telegram file_id of the attachment in a message the bot just sent."""
+    if kind == "photo":
+        return message.photo[-1].file_id if message.photo else None
+    sent_media = message.video if kind == "video" else message.document
+    return sent_media.file_id if sent_media else None
+
+async def fetch_attachments(message: Message, attaches: list) -> tuple[list[tuple[str, InputFile | str, str | None]], list[str]]:
+    """
+    Resolve and download all attachments of a message concurrently, keeping their order.
+    Returns (kind, file, media key) of each file, attachments uploaded before come back as their TG file_id,
+    and link texts for the ones too large for Telegram.
+    """
+    semaphore = Semaphore(ATTACH_CONCURRENCY)
+    # Albums are prefetched so downloads overlap; a lone attachment can be streamed straight through
+    prefetch = sum(isinstance(a, (PhotoAttach, VideoAttach, FileAttach)) for a in attaches) > 1
+
+    async def fetch(attach) -> tuple[str, InputFile | str, str | None] | str | None:
+        key = media_key(attach) if MEDIA_CACHE_SIZE else None
+        if key:
+            file_id = msgs_map.get_file_id(key)
+            metrics.media_cache.inc("hit" if file_id else "miss")
+            if file_id:
+                return key.split(":", 1)[0], file_id, key
+        async with semaphore:
+            url = filename = None
+            try:
+                with metrics.stage_seconds.time("download"):
+                    resolved = await resolve_attachment(message, attach)
+                    if resolved:
+                        kind, url, filename = resolved
+                        prefetch_this = prefetch
+                        # Max photos are far below any limit, everything else is sized up before downloading
+                        if kind != "photo":
+                            size = (attach.size if isinstance(attach, FileAttach) else None) or await media.probe_size(url, REQUESTS_TIMEOUT)
+                            if size and size > UPLOAD_LIMIT:
+                                raise media.FileTooLarge(size)
+                            # Unknown sizes are downloaded first so the limit still holds; a local server takes big files from disk
+                            prefetch_this = prefetch or not size or (TG_API_LOCAL_FILES and size > MEDIA_SPILL_THRESHOLD)
+                        return kind, await download_content(url, filename, prefetch_this), key
+            except media.FileTooLarge as e:
+                l.info(f"{filename} is too large for Telegram ({e.size} bytes), sending a link")
+                return f"📎 {filename} ({e.size / 2 ** 20:.0f} МБ) - слишком большой файл для Telegram: {url}"
+            except Exception as e:
+                metrics.errors.inc("download", type(e).__name__)
+                l.error(f"Attachment error: {e}")
+        return None
+
+    tasks = [create_task(fetch(attach)) for attach in attaches]
+    try:
+        results = await gather(*tasks)
+    except CancelledError:
+        # Attachments that were already downloaded would leave their temp files behind
+        for task in tasks:
+            result = task.result() if task.done() and not task.cancelled() and task.exception() is None else None
+            if isinstance(result, tuple):
+                media.cleanup(result[1])
+        raise
+    return [r for r in results if isinstance(r, tuple)], [r for r in results if isinstance(r, str)]
+
+async def send_attachments(bridge: Bridge, files: list[tuple[str, InputFile | str, str | None]], links: list[str], caption: FormattedText | None, reply_to_tg_id: int | None) -> tuple[list[int], FormattedText | None]:
+    """
+    Sends fetched attachments, photos/videos and documents batched into media groups, then the links.
+    The caption goes on the first item sent, unless it is too long for a caption.
+    Returns sent TG IDs and the caption if it wasn't used.
+    File_ids of new uploads are remembered for the next time the same attachment comes by.
+    """
+    tg_ids = []
+    files = list(files)
+    # An earlier message may have uploaded the same attachment while this one waited in the queue
+    for i, (kind, input_file, key) in enumerate(files):
+        file_id = msgs_map.get_file_id(key) if key and not isinstance(input_file, str) else None
+        if file_id:
+            media.cleanup(input_file)
+            files[i] = (kind, file_id, key)
+    visual = [f for f in files if f[0] != "document"]
+    documents = [f for f in files if f[0] == "document"]
+    batches = [group[i:i + MEDIA_GROUP_SIZE] for group in (visual, documents) for i in range(0, len(group), MEDIA_GROUP_SIZE)]
+    # Long texts go as separate messages after the media instead of failing as a caption
+    if caption is not None and (not caption.strip() or len(caption) > CAPTION_LIMIT):
+        fits, caption = None, caption if caption.strip() else None
+    else:
+        fits = caption
+
+    for batch in batches:
+        try:
+            if len(batch) == 1:
+                kind, input_file, _ = batch[0]
+                send = {"photo": bot.send_photo, "video": bot.send_video, "document": bot.send_document}[kind]
+                sent = [await send(
+                    bridge.tg_chat_id,
+                    as_upload(input_file),
+                    caption=fits.text if fits else None,
+                    caption_entities=fits.entities() if fits else None,
+                    reply_to_message_id=reply_to_tg_id
+                )]
+            else:
+                input_media = {"photo": InputMediaPhoto, "video": InputMediaVideo, "document": InputMediaDocument}
+                sent = await bot.send_media_group(
+                    bridge.tg_chat_id,
+                    [
+                        input_media[kind](
+                            media=as_upload(input_file),
+                            caption=fits.text if fits and i == 0 else None,
+                            caption_entities=fits.entities() if fits and i == 0 else None
+                        )
+                        for i, (kind, input_file, _) in enumerate(batch)
+                    ],
+                    reply_to_message_id=reply_to_tg_id
+                )
+            tg_ids.extend(m.message_id for m in sent)
+            if fits:
+                fits = caption = None # Only send caption once
+            for (kind, input_file, key), m in zip(batch, sent):
+                file_id = sent_file_id(m, kind) if key and not isinstance(input_file, str) else None
+                if file_id:
+                    msgs_map.put_file_id(key, file_id)
+        except Exception as e:
+            metrics.errors.inc("send_attachments", type(e).__name__)
+            l.error(f"Attachment error: {e}")
+            # A remembered file_id may have become invalid (e.g. the bot token changed), don't reuse it
+            for _, input_file, key in batch:
+                if key and isinstance(input_file, str):
+                    msgs_map.forget_file_id(key)
+        finally:
+            for _, input_file, _ in batch:
+                media.cleanup(input_file)
+
+    if links:
+        try:
+            tg_ids.extend(await send_text(bridge, FormattedText("\n".join(links)), reply_to_tg_id))
+        except Exception as e:
+            metrics.errors.inc("send_attachments", type(e).__name__)
+            l.error(f"Could not send links to large files: {e}")
+
+    return tg_ids, caption
+
+async def send_text(bridge: Bridge, text: FormattedText, reply_to_tg_id: int | None = None) -> list[int]:
+    """Sends text split into as many messages as Telegram's limit needs. Returns their TG IDs."""
+    tg_ids = []
+    for part in text.split(TEXT_LIMIT):
+        sent = await bot.send_message(
+            bridge.tg_chat_id,
+            part.text,
+            entities=part.entities(),
+            reply_to_message_id=reply_to_tg_id if not tg_ids else None
+        )
+        tg_ids.append(sent.message_id)
+    return tg_ids
+
+async def coalesce_text(bridge: Bridge, sender: int, text: FormattedText) -> int | None:
+    """Appends text to the previous bridged post if it is recent and from the same sender. Returns its TG ID."""
+    last_post = bridge.last_post
+    if not COALESCE_WINDOW or not last_post:
+        return None
+    if last_post["sender"] != sender or monotonic() - last_post["time"] > COALESCE_WINDOW:
+        return None
+    merged = FormattedText().extend(last_post["text"]).append("\n").extend(text)
+    if len(merged) > TEXT_LIMIT:
+        return None
+    try:
+        await bot.edit_message_text(merged.text, chat_id=bridge.tg_chat_id, message_id=last_post["tg_id"], entities=merged.entities())
+    except Exception as e:
+        l.warning(f"Could not append to TG[{last_post['tg_id']}], sending separately: {e}")
+        return None
+    last_post.update(text=merged, time=monotonic())
+    return last_post["tg_id"]
+
 # --- Logic: Max -> Telegram ---
 
-async def process_max_message(message: Message, forwarded: bool = False) -> int | None:
+def is_bridged(message: Message, bridge: Bridge) -> bool:
     """
-    Handles messages. Returns the Telegram Message ID of the first part sent.
+    Whether a Max message gets posted at all: not from another chat, not the bot's own,
+    and with something postable (stickers, audio, contacts and service events are not).
+    """
+    if message.chat_id != bridge.max_chat_id:
+        return False
+    if message.text and message.text.startswith(BOT_MESSAGE_PREFIX):
+        return False
+    postable = any(isinstance(a, (PhotoAttach, VideoAttach, FileAttach)) for a in message.attaches or [])
+    return bool(message.text or postable or message.link)
+
+async def process_max_message(message: Message, bridge: Bridge, forwarded: bool = False, attachments: Task | None = None) -> list[int]:
+    """
+    Handles messages. Returns the Telegram Message IDs of all parts sent, first part first.
+    `attachments` is an already started fetch_attachments task for this message, if any.
     """
-    global last_sender_id
     assert message.sender
     assert message.chat_id
 
     # 1. Top-level filter
-    l.debug(message)
-    if not forwarded and message.chat_id != MAX_CHAT_ID:
-        return None
+    if LOG_MESSAGE_DUMP_RATE and random() < LOG_MESSAGE_DUMP_RATE:
+        l.info("Max message dump: %r", message)
+    if not forwarded and message.chat_id != bridge.max_chat_id:
+        return []
     if message.text and message.text.startswith(BOT_MESSAGE_PREFIX):
-        return None
+        return []
 
     msg_id_str = str(message.id) if message.id else "FWD_PART"
-    l.info(f"Processing Max Message ID: {msg_id_str} (Forwarded: {forwarded})")
+    l.info("Processing Max Message ID: %s (Forwarded: %s)", msg_id_str, forwarded)
 
-    # This will track the FIRST Telegram ID associated with this Max message
-    first_tg_id = None
+    # This will track every Telegram ID associated with this Max message (header, forwards, attachments, text)
+    tg_ids = []
 
     try:
         sender_name, gender_suffix = await get_smart_sender_info(message.sender)
 
         # 2. Header Logic
-        if not forwarded and last_sender_id != message.sender:
-            header_text = f"{BOT_MESSAGE_PREFIX} *{sender_name} написа{gender_suffix}:*"
-            sent_header = await bot.send_message(TG_CHAT_ID, header_text, parse_mode="Markdown")
-            first_tg_id = sent_header.message_id
-            last_sender_id = message.sender
+        header = None
+        if not forwarded and bridge.last_sender_id != message.sender:
+            header = FormattedText(f"{BOT_MESSAGE_PREFIX} ").append(f"{sender_name} написа{gender_suffix}:", "bold")
+            bridge.last_sender_id = message.sender
 
         # 3. Reply Mapping (Lookup)
         reply_to_tg_id = None
         if message.link and message.link.type == 'REPLY':
             replied_max_id = str(message.link.message.id)
-            reply_to_tg_id = msgs_map.get(replied_max_id)
+            reply_to_tg_id = msgs_map.get(bridge.ns, replied_max_id)
             if reply_to_tg_id:
-                l.info(f"Reply Link: Max[{replied_max_id}] -> TG[{reply_to_tg_id}]")
+                l.info("Reply Link: Max[%s] -> TG[%s]", replied_max_id, reply_to_tg_id)
 
         # 4. Forward Recursion
         fwds_to_process = []
@@ -150,96 +460,240 @@ async def process_max_message(message: Message, forwarded: bool = False) -> int
         if hasattr(message, 'fwd_messages') and message.fwd_messages: # pyright: ignore[reportAttributeAccessIssue]
             fwds_to_process.extend(message.fwd_messages) # pyright: ignore[reportAttributeAccessIssue]
 
+        # Text-only messages carry the header in the same Telegram message, saving a call
+        if header and (fwds_to_process or message.attaches or not message.text):
+            tg_ids.extend(await send_text(bridge, header))
+            header = None
+
         for fwd_msg in fwds_to_process:
-            # Recursive call returns the TG ID of the forwarded message
-            fwd_tg_id = await process_max_message(fwd_msg, forwarded=True)
-            # If our container doesn't have a TG ID yet (no header), use the first forward's ID
-            if first_tg_id is None:
-                first_tg_id = fwd_tg_id
+            # Recursive call returns the TG IDs of the forwarded message; they also belong to our container
+            tg_ids.extend(await process_max_message(fwd_msg, bridge, forwarded=True))
 
         # 5. Content Prep
-        text_content = message.text or ""
+        # Built once and used as the caption or as the text, whichever it ends up being
+        text_content = FormattedText()
+        if header:
+            text_content.extend(header).append("\n")
         if forwarded:
-            text_content = f"↪ Переслано от {sender_name}:_\n{text_content}"
+            text_content.append(f"↪ Переслано от {sender_name}:", "italic").append("\n")
+        text_content.extend(FormattedText.from_max(message.text or "", message.elements))
 
-        # 6. Attachments
+        # 6. Attachments (downloaded in parallel, sent as media groups where possible)
         if message.attaches:
-            for attach in message.attaches:
-                sent = None
-                try:
-                    if isinstance(attach, PhotoAttach):
-                        f_bytes = await download_content(attach.base_url)
-                        sent = await bot.send_photo(
-                            TG_CHAT_ID,
-                            photo=BufferedInputFile(f_bytes.getvalue(), filename="photo.jpg"),
-                            caption=text_content if text_content else None,
-                            reply_to_message_id=reply_to_tg_id,
-                            parse_mode="Markdown"
-                        )
-                    elif isinstance(attach, VideoAttach):
-                        vid_info = await client.get_video_by_id(message.chat_id, message.id, attach.video_id)
-                        if vid_info and vid_info.url:
-                            f_bytes = await download_content(vid_info.url)
-                            sent = await bot.send_video(
-                                TG_CHAT_ID,
-                                video=BufferedInputFile(f_bytes.getvalue(), filename="video.mp4"),
-                                caption=text_content if text_content else None,
-                                reply_to_message_id=reply_to_tg_id,
-                                parse_mode="Markdown"
-                            )
-                    elif isinstance(attach, FileAttach):
-                        file_info = await client.get_file_by_id(message.chat_id, message.id, attach.file_id)
-                        if file_info and file_info.url:
-                            f_bytes = await download_content(file_info.url)
-                            sent = await bot.send_document(
-                                TG_CHAT_ID,
-                                document=BufferedInputFile(f_bytes.getvalue(), filename=getattr(file_info, 'name', 'file')),
-                                caption=text_content if text_content else None,
-                                reply_to_message_id=reply_to_tg_id,
-                                parse_mode="Markdown"
-                            )
-
-                    if sent:
-                        if first_tg_id is None: first_tg_id = sent.message_id
-                        text_content = "" # Only send caption once
-                except Exception as e:
-                    l.error(f"Attachment error: {e}")
+            files, links = await (attachments or fetch_attachments(message, message.attaches))
+            attach_ids, text_content = await send_attachments(bridge, files, links, text_content, reply_to_tg_id)
+            tg_ids.extend(attach_ids)
 
         # 7. Remaining Text
-        if text_content.strip():
-            sent_msg = await bot.send_message(
-                TG_CHAT_ID,
-                text_content,
-                reply_to_message_id=reply_to_tg_id,
-                parse_mode="Markdown"
-            )
-            if first_tg_id is None: first_tg_id = sent_msg.message_id
+        # Plain text (no reply, forward or media) may be merged into the sender's previous post
+        plain = not forwarded and not message.link and not message.attaches
+        if not forwarded and not (plain and text_content and text_content.strip()):
+            bridge.last_post = None
+        if text_content and text_content.strip():
+            merged_id = await coalesce_text(bridge, message.sender, text_content) if plain else None
+            if merged_id:
+                tg_ids.append(merged_id)
+            else:
+                sent_ids = await send_text(bridge, text_content, reply_to_tg_id)
+                tg_ids.extend(sent_ids)
+                if plain:
+                    # Later messages may only be appended to the last piece
+                    last_piece = text_content.split(TEXT_LIMIT)[-1]
+                    bridge.last_post = {"sender": message.sender, "tg_id": sent_ids[-1], "text": last_piece, "time": monotonic()}
 
         # 8. Save Mapping
         # We save mapping for both forwarded items and top-level containers
-        if first_tg_id and message.id:
-            msgs_map[str(message.id)] = first_tg_id
-            data_handler.save('msgs', msgs_map)
-            l.info(f"Mapping Saved: Max[{message.id}] == TG[{first_tg_id}]")
+        if tg_ids and message.id:
+            with metrics.stage_seconds.time("mapping_save"):
+                msgs_map.put(bridge.ns, message.id, tg_ids)
+            l.info("Mapping Saved: Max[%s] == TG%s", message.id, tg_ids)
 
-        return first_tg_id
+        return tg_ids
 
     except Exception as e:
+        metrics.errors.inc("max_to_tg", type(e).__name__)
         l.error(f"Error: {e}", exc_info=True)
-        return None
+        # Keep what did go out mapped, so a replay doesn't post it twice
+        if tg_ids and message.id:
+            msgs_map.put(bridge.ns, message.id, tg_ids)
+        return tg_ids
+
+async def deliver_max_message(message: Message, bridge: Bridge, prefetch: list[Task]):
+    """
+    Delivery job: runs in order with other messages of the same chat.
+    `prefetch` gets the attachment download task once the job is queued.
+    """
+    attachments = prefetch[0] if prefetch else None
+    try:
+        with metrics.stage_seconds.time("max_to_tg"):
+            tg_ids = await process_max_message(message, bridge, attachments=attachments)
+        # Nothing went out: leave it in the outbox, the next backfill replays it
+        if tg_ids or not is_bridged(message, bridge):
+            metrics.messages.inc("max_to_tg")
+            msgs_map.mark_delivered(message.id)
+        else:
+            l.warning("Max message %s was not delivered, kept for replay", message.id)
+    finally:
+        received_ids.discard(str(message.id))
+        if attachments:
+            drop_prefetch(attachments)
+
+def drop_prefetch(task: Task):
+    """Cancel an attachment download still running, or remove the temp files of a finished one."""
+    prefetches.discard(task)
+    if not task.done():
+        # Not awaited: on shutdown a running job must not wait for a whole download
+        task.cancel()
+    elif not task.cancelled() and task.exception() is None:
+        for _, input_file, _ in task.result()[0]:
+            media.cleanup(input_file)
+
+async def queue_max_message(message: Message, bridge: Bridge):
+    """Journal a Max message and queue its delivery."""
+    received_ids.add(str(message.id))
+    msgs_map.record_received(message.chat_id, message.id, message.time)
+    prefetch = []
+    await deliveries.put(message.chat_id, deliver_max_message, message, bridge, prefetch)
+    if message.attaches and is_bridged(message, bridge):
+        # Downloads start once the job is queued, sending waits for its turn.
+        # Messages still waiting for room in a full queue hold no downloads.
+        task = create_task(fetch_attachments(message, message.attaches))
+        prefetches.add(task)
+        prefetch.append(task)
 
 @client.on_message()
 async def max_message_handler(message: Message):
-    # PyMax entry point
-    await process_max_message(message)
+    # PyMax entry point. Runs as a separate task per message, so the job has
+    # to be queued before the first await to keep the chat's order.
+    bridge = router.by_max.get(message.chat_id) # pyright: ignore[reportArgumentType]
+    if bridge is None or not router.owns(bridge) or stopping.is_set():
+        return
+    if not ready.is_set():
+        # Waiters are woken in the order they started waiting, so the order still holds
+        await ready.wait()
+    backfill = backfills.get(bridge.max_chat_id)
+    if backfill and not backfill.is_set():
+        # Missed history goes first, live messages line up behind it
+        await backfill.wait()
+        if is_queued(message, bridge):
+            return
+    await queue_max_message(message, bridge)
+
+def is_queued(message: Message, bridge: Bridge) -> bool:
+    """Already waiting for delivery or delivered."""
+    return str(message.id) in received_ids or msgs_map.get(bridge.ns, message.id) is not None
+
+async def backfill_max_chat(bridge: Bridge):
+    """Queue messages that were never delivered or arrived while we were offline, oldest first."""
+    chat_id = bridge.max_chat_id
+    since = msgs_map.backfill_from(chat_id, BACKFILL_MAX_AGE)
+    if since is None:
+        return
+    # Anything newer is live and waits behind the backfill
+    until = int(time() * 1000)
+    backfilled = 0
+    # Page forward: live messages move the cursor past whatever isn't fetched now
+    while True:
+        page = sorted(await client.fetch_history(chat_id, from_time=since, forward=BACKFILL_LIMIT, backward=0) or [], key=lambda m: m.time)
+        # Pages overlap at their boundary, is_queued drops the repeats
+        missed = [m for m in page if not is_queued(m, bridge)]
+        for m in missed:
+            m.chat_id = m.chat_id or chat_id
+            await queue_max_message(m, bridge)
+        backfilled += len(missed)
+        if len(page) < BACKFILL_LIMIT or page[-1].time >= until or page[-1].time <= since:
+            break
+        since = page[-1].time
+    if backfilled:
+        l.info(f"Backfilled {backfilled} missed Max messages for chat {chat_id}")
+
+@client.on_start
+async def on_max_connected():
+    # Called by PyMax after every (re)connect
+    metrics.max_connects.inc()
+    max_ready.set()
+    if not BACKFILL:
+        return
+    # Before any await, so live messages from now on wait for the backfill
+    for bridge in router.owned:
+        backfills.setdefault(bridge.max_chat_id, Event()).clear()
+    await ready.wait()
+    for bridge in router.owned:
+        try:
+            await backfill_max_chat(bridge)
+        except Exception as e:
+            l.error(f"Backfill failed for chat {bridge.max_chat_id}: {e}", exc_info=True)
+        finally:
+            backfills[bridge.max_chat_id].set()
 
 # --- Logic: Telegram -> Max ---
 
+album_parts: dict[str, list[types.Message]] = {} # media_group_id -> album items that came without the /send caption
+
+def telegram_media(message: types.Message) -> tuple[str, str, str, int | None] | None:
+    """(kind, file_id, filename, size) of the photo, video or document in a Telegram message."""
+    if message.photo:
+        photo = message.photo[-1]
+        return "photo", photo.file_id, "photo.jpg", photo.file_size
+    if message.video:
+        return "video", message.video.file_id, message.video.file_name or "video.mp4", message.video.file_size
+    if message.document:
+        return "document", message.document.file_id, message.document.file_name or "file", message.document.file_size
+    return None
+
+async def collect_album(message: types.Message) -> list[types.Message]:
+    """All items of the album `message` belongs to, in order. Waits ALBUM_WAIT for the rest to arrive."""
+    group_id = message.media_group_id
+    assert group_id
+    await sleep(ALBUM_WAIT)
+    parts = album_parts.pop(group_id, [])
+    return sorted([message, *parts], key=lambda m: m.message_id)
+
+async def transfer_media(items: list[tuple[str, str, str, int | None]], work_dir: str) -> list[dict]:
+    """
+    Download files from Telegram and upload them to Max, several at a time.
+    Each file is uploaded as soon as it is downloaded. Returns Max attach payloads in order.
+    """
+    semaphore = Semaphore(ATTACH_CONCURRENCY)
+    max_file = {"photo": Photo, "video": Video, "document": File}
+
+    async def transfer(i, kind, file_id, filename):
+        # A folder per file keeps the original name, which Max shows
+        target = path.join(work_dir, str(i), path.basename(filename) or "file")
+        makedirs(path.dirname(target))
+        async with semaphore:
+            with metrics.stage_seconds.time("tg_download"):
+                await bot.download(file_id, destination=target, timeout=TG_DOWNLOAD_TIMEOUT)
+            with metrics.stage_seconds.time("max_upload"):
+                return await max_send.upload(client, max_file[kind](path=target))
+
+    return list(await gather(*(transfer(i, *item[:3]) for i, item in enumerate(items))))
+
+async def send_max_media(bridge: Bridge, text: str, items: list[tuple[str, str, str, int | None]], reply_to_max_id: int | None) -> Message:
+    """Send text with Telegram photos/videos/documents to Max as one message."""
+    makedirs(media.TEMP_DIR, exist_ok=True)
+    work_dir = mkdtemp(dir=media.TEMP_DIR)
+    try:
+        attaches = await transfer_media(items, work_dir)
+        return await max_send.send_message(client, bridge.max_chat_id, text, attaches, reply_to=reply_to_max_id)
+    finally:
+        rmtree(work_dir, ignore_errors=True)
+
 @dp.message(Command("send"))
+@metrics.stage_seconds.timed("send_handler")
 async def send_handler(message: types.Message):
     """Handles /send command."""
     assert message.from_user
+    task = current_task()
+    if task:
+        sends_in_flight.add(task)
+        task.add_done_callback(sends_in_flight.discard)
     try:
+        bridge = router.for_tg_chat(message.chat.id)
+        if bridge is None:
+            await message.reply("Этот чат не связан ни с одним чатом Max.")
+            return
+
         # Check time
         now = datetime.now().time()
         if ADMIN_USER_ID and message.from_user.id != ADMIN_USER_ID:
@@ -250,17 +704,28 @@ async def send_handler(message: types.Message):
             await message.reply(f"Можно отправлять сообщения только между {START_TIME:%H:%M} и {END_TIME:%H:%M}")
             return
 
+        # Photos, videos and files: the command is in the caption, album items come as separate messages
+        album = await collect_album(message) if message.media_group_id else [message]
+        items = [item for item in map(telegram_media, album) if item]
+
         # Check empty message
-        text_to_send = (message.text or '').replace("/send", "", 1).strip()
-        if not text_to_send:
+        text_to_send = (message.text or message.caption or '').replace("/send", "", 1).strip()
+        if not text_to_send and not items:
             await message.reply("Нельзя отправить пустое сообщение.")
             return
 
+        too_large = [filename for _, _, filename, size in items if size and size > DOWNLOAD_LIMIT]
+        if too_large:
+            await message.reply(f"Слишком большие файлы: {', '.join(too_large)}. Бот может скачать из Telegram файлы до {DOWNLOAD_LIMIT // 2 ** 20} МБ.")
+            return
+
         # Get username
         username = message.from_user.full_name or message.from_user.username
 
         # Create full text
-        full_text = f"{BOT_MESSAGE_PREFIX} *{username} написал(-а):*\n{text_to_send}"
+        full_text = f"{BOT_MESSAGE_PREFIX} *{username} написал(-а):*"
+        if text_to_send:
+            full_text += f"\n{text_to_send}"
         if BOT_POST_MESSAGE:
             full_text += f"\n{BOT_MESSAGE_PREFIX} {BOT_POST_MESSAGE}"
 
@@ -269,43 +734,121 @@ async def send_handler(message: types.Message):
         if message.reply_to_message:
             tg_reply_id = message.reply_to_message.message_id
             # Reverse lookup
-            for mid, tid in msgs_map.items():
-                if tid == tg_reply_id:
-                    reply_to_max_id = mid
-                    break
+            reply_to_max_id = msgs_map.get_max_id(bridge.ns, tg_reply_id)
 
         # Send message
-        sent_msg = await client.send_message(
-            chat_id=MAX_CHAT_ID,
-            text=full_text,
-            reply_to=reply_to_max_id
-        )
+        with metrics.stage_seconds.time("max_send"):
+            if items:
+                sent_msg = await send_max_media(bridge, full_text, items, reply_to_max_id)
+            else:
+                sent_msg = await client.send_message(
+                    chat_id=bridge.max_chat_id,
+                    text=full_text,
+                    reply_to=reply_to_max_id
+                )
 
         # Map message
         if sent_msg and sent_msg.id:
-            msgs_map[str(sent_msg.id)] = message.message_id
+            # Our own message now sits between bridged posts, don't append across it
+            bridge.last_post = None
+            # Every album item maps to the Max message, the one with the command first
+            msgs_map.put(bridge.ns, sent_msg.id, [message.message_id, *(m.message_id for m in album if m is not message)])
+            metrics.messages.inc("tg_to_max")
             await message.reply("Отправлено!")
 
     except Exception as e:
+        metrics.errors.inc("send_handler", type(e).__name__)
         l.error(f"Error in send_handler: {e}", exc_info=True)
         await message.reply('Произошла ошибка при отправке.')
 
+@dp.message(F.media_group_id)
+async def album_part_handler(message: types.Message):
+    """Keeps album items without the /send caption until the captioned one collects them."""
+    group_id = message.media_group_id
+    assert group_id
+    if group_id not in album_parts:
+        # Albums that were never sent with /send are dropped
+        get_running_loop().call_later(ALBUM_WAIT * 10, lambda: album_parts.pop(group_id, None))
+    album_parts.setdefault(group_id, []).append(message)
+
 # --- Lifecycle ---
 
+def collect_stats() -> dict:
+    return {
+        "deliveries": deliveries.stats,
+        "telegram": throttle.stats,
+        "profiles": profiles.stats,
+        "downloads": dict(media.stats),
+    }
+
+async def report_health(status):
+    """Send a heartbeat with stats to the supervisor every HEALTH_INTERVAL seconds."""
+    while True:
+        status.put({"shard": SHARD_INDEX, "stats": collect_stats()})
+        await sleep(HEALTH_INTERVAL)
+
 async def on_startup():
     l.info("Bot started. Transfer is active.")
 
     # Send startup message (invite link) logic
-    if BOT_START_MESSAGE and not data_handler.load("started"):
+    if not BOT_START_MESSAGE:
+        return
+    started = msgs_map.get_state("started") or []
+    if started is True: # saved by a single-bridge version
+        started = [router.bridges[0].max_chat_id]
+    for bridge in router:
+        if bridge.max_chat_id in started:
+            continue
         try:
-            invite = await bot.create_chat_invite_link(TG_CHAT_ID)
+            invite = await bot.create_chat_invite_link(bridge.tg_chat_id)
             msg = BOT_START_MESSAGE.replace("TG_CHAT_INVITE_LINK", invite.invite_link)
-            await client.send_message(msg, MAX_CHAT_ID)
-            data_handler.save("started", True)
+            await client.send_message(msg, bridge.max_chat_id)
+            started.append(bridge.max_chat_id)
+            msgs_map.set_state("started", started)
         except Exception as e:
-            l.error(f"Failed to send startup message: {e}")
+            l.error(f"Failed to send startup message to chat {bridge.max_chat_id}: {e}")
 
-async def main():
+def load_state():
+    """Blocking part of startup, run in a thread. Profiles are kept in the message store."""
+    msgs_map.open()
+    profiles.load()
+    # Left behind by a crash or a kill; the directory is this process's own
+    rmtree(media.TEMP_DIR, ignore_errors=True)
+
+async def warm_telegram():
+    """First Bot API call, so the connection is open before the first message needs it."""
+    try:
+        me = await bot.get_me()
+        l.info(f"Telegram bot @{me.username}")
+    except Exception as e:
+        # Not fatal: polling and sending retry on their own
+        l.warning(f"Telegram is not reachable yet: {e}")
+
+async def timed(name: str, awaitable):
+    """Await a startup step and report how long it took."""
+    started = monotonic()
+    result = await awaitable
+    elapsed = monotonic() - started
+    metrics.stage_seconds.observe(elapsed, f"startup_{name}")
+    l.info(f"Startup: {name} ready in {elapsed:.2f}s")
+    return result
+
+async def start_telegram():
+    """Telegram -> Max needs Max, so updates are only taken once it is connected."""
+    await max_ready.wait()
+    l.info("Starting Telegram Polling...")
+    # Signals and the bot session are handled by main(): the session is still needed while draining
+    await gather(on_startup(), dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+
+async def drain(timeout: float) -> bool:
+    """Wait for running /send handlers and queued deliveries, up to `timeout` seconds. True if all finished."""
+    joined = create_task(deliveries.join())
+    _, pending = await wait([joined, *sends_in_flight], timeout=timeout)
+    joined.cancel()
+    return not pending
+
+async def main(status=None):
+    """Runs the bridge. `status` is the supervisor's queue when running as a worker process."""
     # 1. Setup Signal Handling
     stop_event = Event()
     loop = get_running_loop()
@@ -313,41 +856,78 @@ async def main():
         for sig in (signal.SIGINT, signal.SIGTERM):
             loop.add_signal_handler(sig, stop_event.set)
 
-    # 2. Start Telegram Poller FIRST (as a background task)
-    l.info("Starting Telegram Polling...")
-    # This creates the task but doesn't block execution
-    tg_task = create_task(dp.start_polling(bot))
-
-    # 3. Run startup logic (invite links, etc.)
-    await on_startup()
-
-    # 4. Start Max Client (This blocks and keeps the script alive)
-    l.info("Initializing Max Client...")
-    max_task = create_task(client.start())
-    l.debug('inited')
-
+    started = monotonic()
+    tasks = []
+    metrics_runner = None
+    max_task = max_timer = None
     try:
-        # We use a task for Max as well to allow clean shutdowns
+        # 2. Shared download session for Max CDN (keep-alive, DNS cache)
+        await media.open_session()
+        if METRICS_PORT:
+            metrics_runner = await metrics.start_server(METRICS_HOST, METRICS_PORT + SHARD_INDEX)
+
+        # 3. Everything that waits on the network or the disk runs at once.
+        # Max connects in the background (and reconnects by itself); its handlers wait for `ready`.
+        l.info("Initializing Max Client...")
+        max_task = create_task(client.start())
+        max_timer = create_task(timed("max", max_ready.wait()))
+        await gather(timed("store", to_thread(load_state)), timed("telegram", warm_telegram()))
+
+        # 4. Ready to deliver
+        deliveries.start()
+        ready.set()
+        l.info(f"Ready in {monotonic() - started:.2f}s")
+
+        if POLL_TELEGRAM:
+            tasks.append(create_task(start_telegram()))
+        if status is not None:
+            tasks.append(create_task(report_health(status)))
+
         # Wait for either the stop signal or the tasks to fail
         stop_task = create_task(stop_event.wait())
         await wait(
-            [tg_task, max_task, stop_task],
+            [*tasks, max_task, stop_task],
             return_when=FIRST_COMPLETED
         )
 
     except Exception as e:
-        l.error(f"Critical error in main loop: {e}")
+        l.error(f"Critical error in main loop: {e}", exc_info=True)
 
     finally:
+        # 5. Stop taking new work, then let what was already taken finish
         l.info("Shutting down...")
-        data_handler.save('msgs', msgs_map)
-
-        # Clean up tasks
-        tg_task.cancel()
-        max_task.cancel()
+        stopping.set()
+        for task in tasks:
+            task.cancel()
+        if ready.is_set():
+            drain_started = monotonic()
+            if await drain(DRAIN_TIMEOUT):
+                l.info(f"Drained in {monotonic() - drain_started:.2f}s")
+            else:
+                l.warning(f"Drain timed out after {DRAIN_TIMEOUT}s with {deliveries.depth} deliveries still queued, backfill picks them up after restart")
+
+        # 6. Nothing runs anymore, stores can be closed
+        for task in (max_timer, max_task):
+            if task:
+                task.cancel()
+        await deliveries.stop()
+        # Downloads for jobs that never ran
+        dropped = list(prefetches)
+        for task in dropped:
+            drop_prefetch(task)
+        await gather(*dropped, return_exceptions=True)
+        l.info(f"Delivery queue: {deliveries.stats}")
+        l.info(f"Telegram throttle: {throttle.stats}")
+        if ready.is_set(): # otherwise the saved profiles were never loaded
+            profiles.save()
+            l.info(f"Profile cache: {profiles.stats}")
+        msgs_map.close()
 
         await client.close()
         await bot.session.close()
+        await media.close_session()
+        if metrics_runner:
+            await metrics_runner.cleanup()
         l.info("Shutdown complete.")
 
 if __name__ == '__main__':
@@ -0,0 +1,46 @@
+"""
+Sending Max messages whose attachments are uploaded in parallel.
+
+PyMax's send_message uploads attachments one after another before sending.
+Here the caller runs the same upload calls concurrently, then the message is
+sent with the same MSG_SEND payload PyMax builds. Tied to the pinned
+maxapi-python version.
+"""
+from time import time
+
+from pymax.exceptions import Error
+from pymax.files import File, Photo, Video
+from pymax.formatting import Formatting
+from pymax.payloads import MessageElement, ReplyLink, SendMessagePayload, SendMessagePayloadMessage
+from pymax.static.enum import Opcode
+from pymax.types import Message
+from pymax.utils import MixinsUtils
+
+async def upload(client, file: Photo | File | Video) -> dict:
+    """Upload one file to Max. Returns the attach payload for send_message. Safe to run concurrently."""
+    attach = await client._upload_attachment(file)
+    if not attach:
+        raise Error("upload_failed", f"Failed to upload {file.file_name}", "Upload Error")
+    return attach
+
+async def send_message(client, chat_id: int, text: str, attaches: list[dict], reply_to: int | None = None, notify: bool = True) -> Message:
+    """client.send_message for attachments that are already uploaded. Markdown in `text` is parsed the same way."""
+    elements, parsed_text = Formatting.get_elements_from_markdown(text)
+    payload = SendMessagePayload(
+        chat_id=chat_id,
+        message=SendMessagePayloadMessage(
+            text=parsed_text if elements else text,
+            cid=int(time() * 1000),
+            elements=[MessageElement(type=e.type, length=e.length, **{"from": e.from_ or 0}) for e in elements],
+            attaches=attaches, # pyright: ignore[reportArgumentType]
+            link=ReplyLink(message_id=str(reply_to)) if reply_to else None,
+        ),
+        notify=notify,
+    ).model_dump(by_alias=True)
+
+    data = await client._send_and_wait(opcode=Opcode.MSG_SEND, payload=payload)
+    if data.get("payload", {}).get("error"):
+        MixinsUtils.handle_error(data)
+    if not data.get("payload"):
+        raise Error("no_message", "Message data missing in response", "Message Error")
+    return Message.from_dict(data["payload"])
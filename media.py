@@ -0,0 +1,162 @@
+import logging
+from os import makedirs, remove, close as close_fd
+from tempfile import mkstemp
+
+import aiofiles
+import aiohttp
+from aiogram.types import BufferedInputFile, FSInputFile, InputFile
+
+import metrics
+
+logger = logging.getLogger()
+
+CHUNK_SIZE = 64 * 1024
+TEMP_DIR = "data/tmp"
+
+session: aiohttp.ClientSession | None = None
+stats = {
+    "connections_created": 0,
+    "connections_reused": 0,
+    "dns_cache_hits": 0,
+    "dns_cache_misses": 0,
+}
+
+def _make_trace_config() -> aiohttp.TraceConfig:
+    trace_config = aiohttp.TraceConfig()
+
+    def count(key):
+        async def handler(session, ctx, params):
+            stats[key] += 1
+        return handler
+
+    trace_config.on_connection_create_end.append(count("connections_created"))
+    trace_config.on_connection_reuseconn.append(count("connections_reused"))
+    trace_config.on_dns_cache_hit.append(count("dns_cache_hits"))
+    trace_config.on_dns_cache_miss.append(count("dns_cache_misses"))
+    return trace_config
+
+async def open_session(limit: int = 20, limit_per_host: int = 8, keepalive_timeout: float = 60, dns_ttl: int = 300):
+    """Create the shared download session. Owned by the bot lifecycle."""
+    global session
+    connector = aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        keepalive_timeout=keepalive_timeout,
+        ttl_dns_cache=dns_ttl,
+    )
+    session = aiohttp.ClientSession(connector=connector, trace_configs=[_make_trace_config()])
+
+async def close_session():
+    global session
+    if session is not None:
+        await session.close()
+        session = None
+        logger.info(f"Download session closed: {stats}")
+
+def get_session() -> aiohttp.ClientSession:
+    if session is None:
+        raise RuntimeError("Download session is not open, call media.open_session() first")
+    return session
+
+class FileTooLarge(Exception):
+    def __init__(self, size: int):
+        super().__init__(f"File is larger than {size} bytes")
+        self.size = size
+
+async def probe_size(url: str, timeout: float) -> int | None:
+    """Size announced by the server for a HEAD request, if any. Errors count as unknown."""
+    try:
+        async with get_session().head(url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            if response.ok:
+                return response.content_length
+    except (aiohttp.ClientError, TimeoutError) as e:
+        logger.debug(f"HEAD {url} failed: {e}")
+    return None
+
+class StreamInputFile(InputFile):
+    """
+    Remote file piped into a Telegram upload chunk by chunk.
+
+    Nothing is buffered: every read() opens a fresh GET, so the file can be
+    re-sent (e.g. on retry) without keeping a copy around.
+    """
+
+    def __init__(self, url: str, filename: str, timeout: float, chunk_size: int = CHUNK_SIZE):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.url = url
+        self.timeout = timeout
+
+    async def read(self, bot):
+        async with get_session().get(self.url, timeout=aiohttp.ClientTimeout(total=None, sock_read=self.timeout)) as response:
+            response.raise_for_status()
+            size = 0
+            try:
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    size += len(chunk)
+                    yield chunk
+            finally:
+                metrics.media_bytes.inc("streamed", amount=size)
+
+class TempInputFile(FSInputFile):
+    """Downloaded file spilled to disk. Call cleanup() once it is sent."""
+
+    def cleanup(self):
+        try:
+            remove(self.path)
+        except FileNotFoundError:
+            pass
+
+async def download(url: str, filename: str, spill_threshold: int, timeout: float, max_size: int | None = None) -> InputFile:
+    """
+    Download a remote file for upload.
+
+    Files up to spill_threshold bytes are kept in memory, bigger ones (or ones
+    that turn out bigger than announced) are written to a temp file chunk by
+    chunk, so peak memory never exceeds the threshold.
+    Raises FileTooLarge as soon as the file is known to exceed max_size.
+    """
+    async with get_session().get(url, timeout=aiohttp.ClientTimeout(total=None, sock_read=timeout)) as response:
+        response.raise_for_status()
+        size = response.content_length
+        if max_size and size is not None and size > max_size:
+            raise FileTooLarge(size)
+        if size is not None and size <= spill_threshold:
+            data = await response.read()
+            metrics.media_bytes.inc("buffered", amount=len(data))
+            return BufferedInputFile(data, filename=filename)
+
+        buffer = bytearray()
+        chunks = response.content.iter_chunked(CHUNK_SIZE)
+        async for chunk in chunks:
+            buffer += chunk
+            if len(buffer) > spill_threshold:
+                break
+        else:
+            metrics.media_bytes.inc("buffered", amount=len(buffer))
+            return BufferedInputFile(bytes(buffer), filename=filename)
+
+        makedirs(TEMP_DIR, exist_ok=True)
+        fd, tmp_path = mkstemp(dir=TEMP_DIR)
+        close_fd(fd)
+        file = TempInputFile(tmp_path, filename=filename)
+        size = len(buffer)
+        try:
+            async with aiofiles.open(tmp_path, "wb") as f:
+                await f.write(buffer)
+                del buffer
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if max_size and size > max_size:
+                        raise FileTooLarge(size)
+                    await f.write(chunk)
+        except BaseException:
+            file.cleanup()
+            raise
+        metrics.media_bytes.inc("spilled", amount=size)
+        logger.debug(f"Spilled {filename} to {tmp_path}")
+        return file
+
+def cleanup(file: InputFile | str | None):
+    """Remove the temp file behind an InputFile, if any."""
+    if isinstance(file, TempInputFile):
+        file.cleanup()
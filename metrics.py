@@ -0,0 +1,139 @@
+import logging
+from bisect import bisect_left
+from contextlib import nullcontext
+from functools import wraps
+from time import perf_counter
+
+from aiohttp import web
+
+logger = logging.getLogger()
+
+# Collection is off until start_server() is called; until then every update is a single flag check
+enabled = False
+_registry = []
+_NULL = nullcontext()
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values = {}
+        _registry.append(self)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}", *self.samples()]
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in self.values.items()]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        if enabled:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(_Metric):
+    """Value read from `fn` on every scrape, so nothing is tracked between scrapes."""
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, fn):
+        super().__init__(name, doc)
+        self.fn = fn
+
+    def samples(self) -> list[str]:
+        return [f"{self.name} {self.fn()}"]
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *exc):
+        self.histogram.observe(perf_counter() - self.start, *self.labels)
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels):
+        if not enabled:
+            return
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def time(self, *labels):
+        """Context manager observing how long its body took."""
+        return _Timer(self, labels) if enabled else _NULL
+
+    def timed(self, *labels):
+        """Decorator observing how long each call of an async function takes."""
+        def decorator(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.time(*labels):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels((*self.labels, 'le'), (*key, bound))} {cumulative}")
+            label_text = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{label_text} {total}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+def render() -> str:
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+async def _handle(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+async def start_server(host: str, port: int) -> web.AppRunner:
+    """Enable collection and serve it at http://host:port/metrics. Call runner.cleanup() to stop."""
+    global enabled
+    enabled = True
+    app = web.Application()
+    app.router.add_get("/metrics", _handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics available at http://{host}:{port}/metrics")
+    return runner
+
+# --- Shared metrics ---
+
+stage_seconds = Histogram("bridge_stage_seconds", "Time spent in each step of bridging a message", ("stage",))
+telegram_seconds = Histogram("bridge_telegram_request_seconds", "Telegram Bot API call latency, without throttling waits", ("method",))
+errors = Counter("bridge_errors_total", "Errors by the step they happened in and exception type", ("stage", "type"))
+media_bytes = Counter("bridge_media_bytes_total", "Attachment bytes downloaded from Max", ("mode",))
+messages = Counter("bridge_messages_total", "Bridged messages", ("direction",))
+media_cache = Counter("bridge_media_cache_total", "Attachment lookups in the Telegram file_id cache", ("result",))
+max_connects = Counter("bridge_max_connects_total", "Connections to Max, including reconnects")
@@ -0,0 +1,397 @@
+import json
+import logging
+import sqlite3
+from collections import OrderedDict
+from os import makedirs, path
+from time import time
+
+import data_handler
+
+logger = logging.getLogger()
+
+# Each entry upgrades the schema from version N to N + 1
+MIGRATIONS = [
+    [
+        "CREATE TABLE IF NOT EXISTS msgs ("
+        "max_id TEXT PRIMARY KEY, "
+        "tg_id INTEGER NOT NULL)",
+    ],
+    [
+        # Every Telegram part (header, attachments, forwards) points back to one Max message
+        "ALTER TABLE msgs ADD COLUMN created REAL NOT NULL DEFAULT 0",
+        "CREATE TABLE parts ("
+        "tg_id INTEGER PRIMARY KEY, "
+        "max_id TEXT NOT NULL, "
+        "created REAL NOT NULL DEFAULT 0)",
+        "CREATE INDEX parts_max_id ON parts (max_id)",
+        "CREATE INDEX msgs_created ON msgs (created)",
+        "INSERT OR IGNORE INTO parts (tg_id, max_id) SELECT tg_id, max_id FROM msgs",
+    ],
+    [
+        # Max messages received but not yet delivered, and the newest one seen per chat
+        "CREATE TABLE outbox ("
+        "max_id TEXT PRIMARY KEY, "
+        "chat_id INTEGER NOT NULL, "
+        "time INTEGER NOT NULL)",
+        "CREATE TABLE cursors ("
+        "chat_id INTEGER PRIMARY KEY, "
+        "max_id TEXT NOT NULL, "
+        "time INTEGER NOT NULL)",
+    ],
+    [
+        # Per-bridge namespaces: TG message ids are only unique inside one TG chat.
+        # Existing rows get namespace 0 and are claimed by the default bridge on open.
+        "ALTER TABLE msgs RENAME TO msgs_v3",
+        "CREATE TABLE msgs ("
+        "ns INTEGER NOT NULL DEFAULT 0, "
+        "max_id TEXT NOT NULL, "
+        "tg_id INTEGER NOT NULL, "
+        "created REAL NOT NULL DEFAULT 0, "
+        "PRIMARY KEY (ns, max_id))",
+        "INSERT INTO msgs (max_id, tg_id, created) SELECT max_id, tg_id, created FROM msgs_v3",
+        "DROP TABLE msgs_v3",
+        "ALTER TABLE parts RENAME TO parts_v3",
+        "CREATE TABLE parts ("
+        "ns INTEGER NOT NULL DEFAULT 0, "
+        "tg_id INTEGER NOT NULL, "
+        "max_id TEXT NOT NULL, "
+        "created REAL NOT NULL DEFAULT 0, "
+        "PRIMARY KEY (ns, tg_id))",
+        "INSERT INTO parts (tg_id, max_id, created) SELECT tg_id, max_id, created FROM parts_v3",
+        "DROP TABLE parts_v3",
+        "CREATE INDEX parts_max_id ON parts (ns, max_id)",
+        "CREATE INDEX msgs_created ON msgs (created)",
+    ],
+    [
+        # Telegram file_ids of already uploaded Max attachments, so repeats are sent without a transfer
+        "CREATE TABLE media ("
+        "key TEXT PRIMARY KEY, "
+        "file_id TEXT NOT NULL, "
+        "used REAL NOT NULL)",
+        "CREATE INDEX media_used ON media (used)",
+    ],
+    [
+        # Profile cache and small state, formerly in data.json, which worker processes can't share safely
+        "CREATE TABLE profiles ("
+        "user_id INTEGER PRIMARY KEY, "
+        "fetched REAL NOT NULL, "
+        "profile TEXT NOT NULL)",
+        "CREATE TABLE state ("
+        "key TEXT PRIMARY KEY, "
+        "value TEXT NOT NULL)",
+    ],
+]
+
+class BiMap:
+    """
+    In-memory two-way Max <-> Telegram id index.
+
+    One Max message maps to a primary Telegram id plus any number of parts;
+    every part maps back to its Max message. Optionally bounded by entry
+    count (LRU) and/or age in seconds. Keys are opaque, callers pick them.
+    """
+
+    def __init__(self, max_size=None, max_age=None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.forward = OrderedDict() # max_id -> (created, primary tg_id, parts)
+        self.backward = {} # tg_id -> max_id
+
+    def put(self, max_id, tg_ids, created=None):
+        self.discard(max_id)
+        for tg_id in tg_ids:
+            self.backward[tg_id] = max_id
+        self.forward[max_id] = (created or time(), tg_ids[0], tuple(tg_ids))
+        self._evict()
+
+    def get(self, max_id):
+        entry = self.forward.get(max_id)
+        if entry is None:
+            return None
+        if self._expired(entry):
+            self.discard(max_id)
+            return None
+        self.forward.move_to_end(max_id)
+        return entry[1]
+
+    def get_max_id(self, tg_id):
+        max_id = self.backward.get(tg_id)
+        if max_id is None or self.get(max_id) is None:
+            return None
+        return max_id
+
+    def discard(self, max_id):
+        entry = self.forward.pop(max_id, None)
+        if entry is None:
+            return
+        for tg_id in entry[2]:
+            if self.backward.get(tg_id) == max_id:
+                del self.backward[tg_id]
+
+    def _expired(self, entry):
+        return bool(self.max_age) and time() - entry[0] > self.max_age
+
+    def _evict(self):
+        while self.forward:
+            max_id, entry = next(iter(self.forward.items()))
+            if not (self.max_size and len(self.forward) > self.max_size) and not self._expired(entry):
+                break
+            self.discard(max_id)
+
+    def __len__(self):
+        return len(self.forward)
+
+class MsgsStore:
+    """
+    Persistent Max <-> Telegram message id mapping.
+
+    Backed by SQLite in WAL mode, so every insert is a small append to the
+    write-ahead log instead of a rewrite of the whole data file. Recent
+    entries are kept in a BiMap so lookups in both directions skip the DB.
+
+    Also journals incoming Max messages until they are delivered (outbox),
+    so deliveries cut short by a restart can be found and replayed, and
+    remembers Telegram file_ids of uploaded attachments (least recently
+    used ones are dropped beyond media_cache_size). Cached Max profiles and
+    small bits of state live here too, since worker processes share the file.
+
+    Nothing touches the disk until open() is called, so it can run in a
+    thread while the connections are being set up.
+    """
+
+    def __init__(self, file="data/msgs.db", cache_size=None, max_age=None, default_ns=None, media_cache_size=None):
+        self.file = file
+        self.max_age = max_age
+        self.media_cache_size = media_cache_size
+        self.default_ns = default_ns
+        self.cache = BiMap(cache_size, max_age)
+        self.conn: sqlite3.Connection | None = None
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        assert self.conn is not None, "MsgsStore.open() has not been called"
+        return self.conn
+
+    def open(self):
+        """Connect, upgrade the schema, import legacy data and prune old mappings."""
+        makedirs(path.dirname(self.file) or ".", exist_ok=True)
+        # Autocommit mode: each statement is its own (atomic) transaction.
+        # Several worker processes may share the file, so wait for their locks instead of failing.
+        self.conn = sqlite3.connect(self.file, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # IMMEDIATE takes the write lock up front, so worker processes starting together migrate one at a time
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._migrate_schema()
+            imported = self._migrate_legacy()
+        # Only once the import is committed, so a crash in between loses nothing
+        for key in imported:
+            data_handler.delete(key)
+        if self.default_ns is not None:
+            self._db.execute("UPDATE msgs SET ns = ? WHERE ns = 0", (self.default_ns,))
+            self._db.execute("UPDATE parts SET ns = ? WHERE ns = 0", (self.default_ns,))
+        if self.max_age:
+            self.prune(self.max_age)
+        return self
+
+    def _migrate_schema(self):
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        for target, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in statements:
+                self._db.execute(statement)
+            self._db.execute(f"PRAGMA user_version = {target}")
+            logger.info(f"Upgraded {self.file} schema to version {target}")
+
+    def _migrate_legacy(self):
+        """
+        One-time import of the old 'msgs', 'profiles' and 'started' keys from data.json.
+        Returns the imported keys; the caller deletes them after committing.
+        """
+        imported = []
+        legacy = data_handler.load('msgs')
+        if legacy:
+            ns = self.default_ns or 0
+            rows = [(ns, str(mid), int(tid)) for mid, tid in legacy.items()]
+            self._db.executemany("INSERT OR IGNORE INTO msgs (ns, max_id, tg_id) VALUES (?, ?, ?)", rows)
+            self._db.executemany("INSERT OR IGNORE INTO parts (ns, max_id, tg_id) VALUES (?, ?, ?)", rows)
+            imported.append('msgs')
+            logger.info(f"Migrated {len(legacy)} message mappings from data.json to {self.file}")
+        profiles = data_handler.load('profiles')
+        if profiles:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO profiles (user_id, fetched, profile) VALUES (?, ?, ?)",
+                ((int(uid), fetched, json.dumps(profile)) for uid, (fetched, profile) in profiles.items())
+            )
+            imported.append('profiles')
+        started = data_handler.load('started')
+        if started is not None:
+            self._db.execute("INSERT OR IGNORE INTO state (key, value) VALUES ('started', ?)", (json.dumps(started),))
+            imported.append('started')
+        return imported
+
+    def get(self, ns, max_id):
+        """Primary Telegram id for a Max message."""
+        max_id = str(max_id)
+        cached = self.cache.get((ns, max_id))
+        if cached is not None:
+            return cached[1]
+        row = self._db.execute(
+            "SELECT tg_id, created FROM msgs WHERE ns = ? AND max_id = ?", (ns, max_id)
+        ).fetchone()
+        if not row:
+            return None
+        self._warm(ns, max_id, row[0], row[1])
+        return row[0]
+
+    def get_max_id(self, ns, tg_id):
+        """Max message id that produced a given Telegram message."""
+        key = self.cache.get_max_id((ns, tg_id))
+        if key is not None:
+            return key[1]
+        row = self._db.execute("SELECT max_id FROM parts WHERE ns = ? AND tg_id = ?", (ns, tg_id)).fetchone()
+        if not row:
+            return None
+        primary = self.get(ns, row[0])
+        return row[0] if primary is not None else None
+
+    def _warm(self, ns, max_id, primary, created):
+        parts = [r[0] for r in self._db.execute("SELECT tg_id FROM parts WHERE ns = ? AND max_id = ?", (ns, max_id))]
+        if primary in parts:
+            parts.remove(primary)
+        self._cache_put(ns, max_id, [primary, *parts], created or None)
+
+    def _cache_put(self, ns, max_id, tg_ids, created):
+        self.cache.put((ns, max_id), [(ns, tg_id) for tg_id in tg_ids], created)
+
+    def put(self, ns, max_id, tg_ids):
+        """Map a Max message to its Telegram parts. The first id is the primary one."""
+        if isinstance(tg_ids, int):
+            tg_ids = [tg_ids]
+        max_id = str(max_id)
+        created = time()
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.execute(
+                "INSERT OR REPLACE INTO msgs (ns, max_id, tg_id, created) VALUES (?, ?, ?, ?)",
+                (ns, max_id, tg_ids[0], created)
+            )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO parts (ns, tg_id, max_id, created) VALUES (?, ?, ?, ?)",
+                ((ns, tg_id, max_id, created) for tg_id in tg_ids)
+            )
+        self._cache_put(ns, max_id, tg_ids, created)
+
+    def prune(self, max_age):
+        """Drop mappings older than max_age seconds from disk."""
+        cutoff = time() - max_age
+        with self._db:
+            self._db.execute("BEGIN")
+            # Legacy rows have created = 0, stamp them instead of dropping everything at once
+            self._db.execute("UPDATE msgs SET created = ? WHERE created = 0", (time(),))
+            self._db.execute("UPDATE parts SET created = ? WHERE created = 0", (time(),))
+            removed = self._db.execute("DELETE FROM msgs WHERE created < ?", (cutoff,)).rowcount
+            self._db.execute("DELETE FROM parts WHERE created < ?", (cutoff,))
+        if removed:
+            logger.info(f"Pruned {removed} message mappings older than {max_age}s")
+
+    def record_received(self, chat_id, max_id, msg_time):
+        """Journal a Max message on receipt and advance the chat's last-seen cursor."""
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.execute(
+                "INSERT OR IGNORE INTO outbox (max_id, chat_id, time) VALUES (?, ?, ?)",
+                (str(max_id), chat_id, msg_time)
+            )
+            self._db.execute(
+                "INSERT INTO cursors (chat_id, max_id, time) VALUES (?, ?, ?) "
+                "ON CONFLICT (chat_id) DO UPDATE SET max_id = excluded.max_id, time = excluded.time "
+                "WHERE excluded.time >= cursors.time",
+                (chat_id, str(max_id), msg_time)
+            )
+
+    def mark_delivered(self, max_id):
+        self._db.execute("DELETE FROM outbox WHERE max_id = ?", (str(max_id),))
+
+    def backfill_from(self, chat_id, max_age):
+        """
+        Time (ms) to replay a chat's history from: the oldest undelivered message
+        or the last one seen, whichever is earlier, but no older than max_age seconds.
+        None if the chat was never seen.
+        """
+        cutoff = int((time() - max_age) * 1000)
+        self._db.execute("DELETE FROM outbox WHERE time < ?", (cutoff,))
+        pending = self._db.execute("SELECT MIN(time) FROM outbox WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+        cursor = self._db.execute("SELECT time FROM cursors WHERE chat_id = ?", (chat_id,)).fetchone()
+        candidates = [t for t in (pending, cursor[0] if cursor else None) if t is not None]
+        if not candidates:
+            return None
+        return max(min(candidates), cutoff)
+
+    def get_file_id(self, key):
+        """Telegram file_id of an attachment uploaded before, if still remembered."""
+        row = self._db.execute("SELECT file_id FROM media WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None
+        self._db.execute("UPDATE media SET used = ? WHERE key = ?", (time(), key))
+        return row[0]
+
+    def put_file_id(self, key, file_id):
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.execute("INSERT OR REPLACE INTO media (key, file_id, used) VALUES (?, ?, ?)", (key, file_id, time()))
+            if self.media_cache_size:
+                self._db.execute(
+                    "DELETE FROM media WHERE key IN (SELECT key FROM media ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                    (self.media_cache_size,)
+                )
+
+    def forget_file_id(self, key):
+        self._db.execute("DELETE FROM media WHERE key = ?", (key,))
+
+    def load_profiles(self, max_age, limit):
+        """(user_id, fetched, profile) of profiles fetched less than max_age seconds ago, newest first."""
+        rows = self._db.execute(
+            "SELECT user_id, fetched, profile FROM profiles WHERE fetched >= ? ORDER BY fetched DESC LIMIT ?",
+            (time() - max_age, limit)
+        )
+        return [(user_id, fetched, json.loads(profile)) for user_id, fetched, profile in rows]
+
+    def save_profiles(self, entries, max_age):
+        """
+        Store (user_id, fetched, profile) entries. Other processes' profiles are
+        kept, the fresher copy wins, and ones older than max_age are dropped.
+        """
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "INSERT INTO profiles (user_id, fetched, profile) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET fetched = excluded.fetched, profile = excluded.profile "
+                "WHERE excluded.fetched > profiles.fetched",
+                ((user_id, fetched, json.dumps(profile)) for user_id, fetched, profile in entries)
+            )
+            self._db.execute("DELETE FROM profiles WHERE fetched < ?", (time() - max_age,))
+
+    def get_state(self, key):
+        """Small JSON value shared by all processes, None if never set."""
+        row = self._db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_state(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM msgs").fetchone()[0]
+
+    def compact(self):
+        """Fold the WAL back into the main database file."""
+        self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        if self.conn is None:
+            return
+        try:
+            self.compact()
+        finally:
+            self.conn.close()
+            self.conn = None
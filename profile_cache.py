@@ -0,0 +1,89 @@
+import logging
+from asyncio import CancelledError, Future, get_running_loop, shield
+from collections import OrderedDict
+from time import time
+
+logger = logging.getLogger()
+
+class ProfileCache:
+    """
+    TTL + LRU cache for Max user profiles.
+
+    Concurrent lookups of the same user share one request (single-flight).
+    Entries can be persisted in a MsgsStore so restarts start warm.
+    """
+
+    def __init__(self, fetch, store=None, ttl=6 * 3600, max_size=1000):
+        self.fetch = fetch # async (user_id) -> dict | None
+        self.store = store # MsgsStore (load_profiles / save_profiles), None - not persisted
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict() # user_id -> (fetched_at, profile)
+        self.pending: dict[int, Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def load(self):
+        """Restore entries saved by a previous run, dropping expired ones."""
+        if self.store is None:
+            return
+        # Newest first from the store, the LRU order wants oldest first
+        for user_id, fetched_at, profile in reversed(self.store.load_profiles(self.ttl, self.max_size)):
+            self.entries[user_id] = (fetched_at, profile)
+        logger.info(f"Loaded {len(self.entries)} cached profiles")
+
+    def save(self):
+        if self.store is not None:
+            self.store.save_profiles(((uid, fetched_at, profile) for uid, (fetched_at, profile) in self.entries.items()), self.ttl)
+
+    async def get(self, user_id: int) -> dict | None:
+        entry = self.entries.get(user_id)
+        if entry and time() - entry[0] < self.ttl:
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+        pending = self.pending.get(user_id)
+        if pending is not None:
+            self.coalesced += 1
+            try:
+                # Shielded: a waiter being cancelled must not cancel the lookup others share
+                return await shield(pending)
+            except CancelledError:
+                if not pending.cancelled():
+                    raise
+                # The lookup itself was cancelled, do our own
+        self.misses += 1
+
+        future = get_running_loop().create_future()
+        self.pending[user_id] = future
+        try:
+            profile = await self.fetch(user_id)
+            if profile is not None:
+                self.entries[user_id] = (time(), profile)
+                self.entries.move_to_end(user_id)
+                self._evict()
+            if not future.done():
+                future.set_result(profile)
+            return profile
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+                # Mark retrieved so a lookup nobody else waited on doesn't log "never retrieved"
+                future.exception()
+            raise
+        finally:
+            # Cancelled midway: let waiters know instead of leaving them hanging
+            if not future.done():
+                future.cancel()
+            if self.pending.get(user_id) is future:
+                del self.pending[user_id]
+
+    def _evict(self):
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    @property
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced}
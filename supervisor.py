@@ -0,0 +1,141 @@
+"""
+Runs the bridge as several worker processes, each delivering its shard of
+the configured bridges (see bridges.shard_for).
+
+Workers share the SQLite message store, the first one also polls Telegram.
+Crashed or silent workers are restarted with backoff.
+Usage: `WORKERS=4 python supervisor.py` instead of `python main.py`.
+"""
+import signal
+from multiprocessing import get_context
+from os import environ, getenv
+from queue import Empty
+from time import monotonic
+from logging import getLogger
+
+from logger import setup_logger
+
+WORKERS = int(getenv('WORKERS', 2)) # сколько процессов-обработчиков запускать
+HEARTBEAT_TIMEOUT = 120 # через сколько секунд без отчёта процесс считается зависшим и перезапускается
+RESTART_DELAY = 5 # пауза перед перезапуском упавшего процесса (удваивается, если он падает снова)
+RESTART_DELAY_MAX = 300
+STABLE_UPTIME = 120 # сколько секунд процесс должен проработать без падений, чтобы пауза перед перезапуском снова стала RESTART_DELAY
+STATS_INTERVAL = 60 # как часто (в секундах) писать в лог сводную статистику
+SHUTDOWN_TIMEOUT = 30 # сколько ждать штатного завершения процессов перед принудительной остановкой
+
+l = getLogger("api_logger")
+
+def run_worker(shard: int, shards: int, status):
+    # Must be set before main is imported: it reads the shard at import time
+    environ['BRIDGE_SHARD'] = f"{shard}/{shards}"
+    from asyncio import run
+    import main
+    try:
+        run(main.main(status))
+    except KeyboardInterrupt:
+        pass
+
+def merge_stats(reports: list[dict]) -> dict:
+    """Sums counters across workers, lags are the worst one."""
+    total = {}
+    for report in reports:
+        for group, values in report.items():
+            merged = total.setdefault(group, {})
+            for key, value in values.items():
+                if key.endswith("lag"):
+                    merged[key] = max(merged.get(key, 0), value)
+                else:
+                    merged[key] = merged.get(key, 0) + value
+    return total
+
+class Supervisor:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.ctx = get_context("spawn")
+        self.status = self.ctx.Queue()
+        self.procs = {}
+        self.heartbeats = {}
+        self.started_at = {}
+        self.stats = {}
+        self.restarts = {shard: 0 for shard in range(workers)}
+        self.restart_at = {}
+        self.stopping = False
+
+    def start_worker(self, shard: int):
+        proc = self.ctx.Process(target=run_worker, args=(shard, self.workers, self.status), name=f"bridge-{shard}")
+        proc.start()
+        self.procs[shard] = proc
+        self.heartbeats[shard] = self.started_at[shard] = monotonic()
+        l.info(f"Started worker {shard}/{self.workers} (pid {proc.pid})")
+
+    def schedule_restart(self, shard: int, reason: str):
+        delay = min(RESTART_DELAY_MAX, RESTART_DELAY * 2 ** self.restarts[shard])
+        self.restarts[shard] += 1
+        self.restart_at[shard] = monotonic() + delay
+        del self.procs[shard]
+        l.warning(f"Worker {shard} {reason}, restarting in {delay}s")
+
+    def check_workers(self):
+        now = monotonic()
+        for shard, proc in list(self.procs.items()):
+            if not proc.is_alive():
+                self.schedule_restart(shard, f"exited with code {proc.exitcode}")
+            elif now - self.heartbeats[shard] > HEARTBEAT_TIMEOUT:
+                proc.kill()
+                proc.join()
+                self.schedule_restart(shard, f"sent no heartbeat for {HEARTBEAT_TIMEOUT}s")
+        for shard, at in list(self.restart_at.items()):
+            if now >= at:
+                del self.restart_at[shard]
+                self.start_worker(shard)
+
+    def read_status(self, timeout: float):
+        try:
+            report = self.status.get(timeout=timeout)
+        except Empty:
+            return
+        shard = report["shard"]
+        if shard in self.procs:
+            # A worker that has stayed up for a while has recovered, so the next crash starts the backoff over.
+            # Not on the first heartbeat: a worker crashing right after startup would restart every RESTART_DELAY.
+            if monotonic() - self.started_at[shard] >= STABLE_UPTIME:
+                self.restarts[shard] = 0
+            self.heartbeats[shard] = monotonic()
+            self.stats[shard] = report["stats"]
+
+    def stop(self, *_):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for shard in range(self.workers):
+            self.start_worker(shard)
+
+        last_stats = monotonic()
+        while not self.stopping:
+            self.read_status(timeout=1)
+            self.check_workers()
+            if monotonic() - last_stats >= STATS_INTERVAL:
+                last_stats = monotonic()
+                l.info(f"Workers alive: {len(self.procs)}/{self.workers}, restarts: {self.restarts}, "
+                       f"stats: {merge_stats(list(self.stats.values()))}")
+
+        l.info("Stopping workers...")
+        for proc in self.procs.values():
+            proc.terminate() # SIGTERM, workers shut down gracefully
+        deadline = monotonic() + SHUTDOWN_TIMEOUT
+        for shard, proc in self.procs.items():
+            proc.join(max(0, deadline - monotonic()))
+            if proc.is_alive():
+                l.warning(f"Worker {shard} did not stop in time, killing it")
+                proc.kill()
+                proc.join()
+        l.info("All workers stopped.")
+
+if __name__ == "__main__":
+    setup_logger('.supervisor')
+    if WORKERS < 1:
+        l.critical("WORKERS must be at least 1")
+        exit(1)
+    Supervisor(WORKERS).run()
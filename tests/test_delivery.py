@@ -0,0 +1,29 @@
+import asyncio
+from random import Random
+
+from delivery import DeliveryQueue
+
+def test_order_kept_when_queue_is_full():
+    """Producers blocked on a full queue must not be overtaken by later arrivals."""
+    async def run(seed):
+        rnd = Random(seed)
+        delivered = []
+        async def handler(i):
+            await asyncio.sleep(rnd.random() / 1000)
+            delivered.append(i)
+
+        deliveries = DeliveryQueue(workers=1, max_size=2)
+        deliveries.start()
+        # Like PyMax: one task per incoming message, started in arrival order
+        producers = []
+        for i in range(30):
+            producers.append(asyncio.create_task(deliveries.put("chat", handler, i)))
+            if rnd.random() < 0.3:
+                await asyncio.sleep(rnd.random() / 1000)
+        await asyncio.gather(*producers)
+        await deliveries.join()
+        await deliveries.stop()
+        return delivered
+
+    for seed in range(30):
+        assert asyncio.run(run(seed)) == list(range(30))
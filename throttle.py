@@ -0,0 +1,103 @@
+import logging
+from asyncio import Lock, sleep
+from random import uniform
+from time import monotonic
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramEntityTooLarge, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+import metrics
+
+logger = logging.getLogger()
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts up to `capacity`. Waiters are served FIFO."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.blocked_until = 0.0
+        self.lock = Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = monotonic()
+                if now < self.blocked_until:
+                    await sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await sleep((1 - self.tokens) / self.rate)
+
+    def block(self, seconds: float):
+        """Hold everyone back for `seconds` (e.g. after a flood-control answer)."""
+        self.blocked_until = max(self.blocked_until, monotonic() + seconds)
+        self.tokens = 0
+
+class ThrottleMiddleware(BaseRequestMiddleware):
+    """
+    Paces every outgoing Telegram call and retries the ones that fail transiently.
+
+    Calls that target a chat pass a global bucket and that chat's own bucket.
+    TelegramRetryAfter pauses the chat for the time Telegram asks for, network
+    and server errors are retried with jittered exponential backoff.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=20 / 60, chat_burst=20, max_retries=5, base_delay=1.0, max_delay=60.0):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets: dict[int | str, TokenBucket] = {}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+        self.flood_waits = 0
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        # Only chat-bound calls are paced, getUpdates & co. go straight through
+        if chat_id is None:
+            return await make_request(bot, method)
+        bucket = self._chat_bucket(chat_id)
+
+        attempt = 0
+        while True:
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                with metrics.telegram_seconds.time(method.__api_method__):
+                    return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                metrics.errors.inc("telegram", type(e).__name__)
+                if attempt >= self.max_retries:
+                    raise
+                self.flood_waits += 1
+                logger.warning(f"Flood control in chat {chat_id}, retrying {method.__api_method__} in {e.retry_after}s")
+                bucket.block(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                metrics.errors.inc("telegram", type(e).__name__)
+                if isinstance(e, TelegramEntityTooLarge) or attempt >= self.max_retries:
+                    raise
+                delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+                delay = uniform(delay / 2, delay)
+                logger.warning(f"{method.__api_method__} failed ({e}), retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+                await sleep(delay)
+            attempt += 1
+            self.retries += 1
+
+    @property
+    def stats(self):
+        return {"retries": self.retries, "flood_waits": self.flood_waits}